@@ -4,33 +4,93 @@ import argparse
 import yaml
 import logging
 
-from ingester.es_common import *
-from ingester.nlp_service import *
-from ingester.annotations_indexer import *
+# prefer the libyaml based loader when the bindings are available
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+from ingester.es_common import ElasticConnector, ElasticConnectorConfig, ElasticIndexer, ElasticRangedIndexer, SslConnectionConfig
+from ingester.nlp_service import NlpService
+from ingester.annotations_indexer import AnnotationIndexerConfig, BatchAnnotationsIndexer
 
 class AppConfig:
     """
     The configuration file for the indexer application
     """
+
+    # the parameters that must be present in the configuration, specified as key paths
+    REQUIRED_PARAMS = [
+        ('source', 'es', 'hosts'),
+        ('source', 'es', 'index-name'),
+        ('sink', 'es', 'hosts'),
+        ('sink', 'es', 'index-name'),
+        ('nlp-service', 'endpoint-url'),
+        ('mapping', 'source', 'text-field'),
+        ('mapping', 'source', 'docid-field'),
+        ('mapping', 'source', 'batch', 'date-field'),
+        ('mapping', 'source', 'batch', 'date-start'),
+        ('mapping', 'source', 'batch', 'date-end'),
+    ]
+
     def __init__(self, file_path):
         """
         :param: filepath: the path for the configuration file stored in YAML
         """
         try:
             with open(file_path) as conf_file:
-                yaml_file = yaml.safe_load(conf_file)
+                yaml_file = yaml.load(conf_file, Loader=_YamlLoader)
 
-                if 'source' not in yaml_file or \
+                if not isinstance(yaml_file, dict) or \
+                        'source' not in yaml_file or \
                         'nlp-service' not in yaml_file or \
                         'sink' not in yaml_file or \
                         'mapping' not in yaml_file:
                     raise Exception("Invalid configuration file provided")
 
+                self._validate(yaml_file)
                 self.params = yaml_file
 
         except FileNotFoundError:
             raise Exception("Cannot open configuration file")
 
+    def _validate(self, params):
+        """
+        Checks up-front that all the required parameters are present, so that the application
+        fails fast instead of midway through initializing its components
+        :param params: the parsed configuration
+        """
+        for key_path in self.REQUIRED_PARAMS:
+            value = params
+            for key in key_path:
+                if not isinstance(value, dict) or value.get(key) is None:
+                    raise Exception("Invalid configuration file provided: missing '%s'" % '.'.join(key_path))
+                value = value[key]
+
+
+def create_es_connector_config(es_params, thread_count):
+    """
+    Creates the ElasticSearch connector configuration from the `source` or `sink` parameters
+    :param es_params: the `es` entry of the source or sink configuration
+    :param thread_count: the number of threads using the connection
+    :return: the connector configuration :class:`~ElasticConnectorConfig`
+    """
+    security = es_params.get('security') or {}
+    ssl_config = SslConnectionConfig(ca_file_path=security.get('ca-file-path'),
+                                     ca_certs_path=security.get('ca-certs-path'),
+                                     client_cert_path=security.get('client-cert-path'),
+                                     client_key_path=security.get('client-key-path'))
+
+    extra_params = {'verify-certs': True, 'use-ssl': False}
+    extra_params.update(es_params.get('extra-params') or {})
+
+    return ElasticConnectorConfig(hosts=es_params['hosts'],
+                                  credentials=es_params.get('credentials') or None,
+                                  extra_params=extra_params,
+                                  ssl_config=ssl_config,
+                                  thread_count=thread_count)
+
+
 if __name__ == "__main__":
     # parse the input parameters
     parser = argparse.ArgumentParser(description='ElasticSearch-to-ElasticSearch annotations indexer')
@@ -46,75 +106,80 @@ if __name__ == "__main__":
 
         # setup logging
         log_format = '[%(asctime)s] [%(levelname)s] %(name)s: %(message)s'
-        if config.params['logging-level']:
-            logging.basicConfig(format=log_format, level=int(config.params['logging-level']))
-        else:
-            logging.basicConfig(format=log_format, level=logging.INFO)
-        logging.getLogger('elasticsearch')
-
-        # initialize the elastic source
-        source_params = config.params['source']
+        logging_level = int(config.params.get('logging-level') or logging.INFO)
+        logging.basicConfig(format=log_format, level=logging_level)
 
-        source_credentials = source_params['es']['credentials'] if source_params['es']['credentials'] else None
-        source_extra_params = source_params['es']['extra-params'] if source_params['es']['extra-params'] else None
-        source_security = source_params['es']['security']  if source_params['es']['security'] else None
+        source_es_params = config.params['source']['es']
+        sink_es_params = config.params['sink']['es']
+        nlp_params = config.params['nlp-service']
+        nlp_credentials = nlp_params.get('credentials') or {}
 
-        source_ssl_config = SslConnectionConfig(ca_file_path=source_security['ca-file-path'],
-                                                ca_certs_path=source_security['ca-certs-path'],
-                                                client_cert_path=source_security['client-cert-path'],
-                                                client_key_path=source_security['client-key-path'])
+        mapping = config.params['mapping']
+        source_mapping = mapping['source']
+        batch_params = source_mapping['batch']
+        ingest_mode = mapping.get('index-ingest-mode') or {}
+        sink_mapping = mapping.get('sink') or {}
+        nlp_mapping = mapping.get('nlp') or {}
 
-        es_source_conf = ElasticConnectorConfig(hosts=source_params['es']['hosts'], credentials=source_credentials, extra_params=source_extra_params,
-                                                   ssl_config=source_ssl_config)
+        # the number of documents waiting for processing is bounded to twice the number of threads by default
+        threads = batch_params.get('threads', 4)
+        queue_size = batch_params.get('queue-size') or 2 * threads
 
-        es_source_conn = ElasticConnector(es_source_conf)
-        es_source = ElasticRangedIndexer(es_source_conn, source_params['es']['index-name'])
+        # initialize the elastic source
+        es_source_conn = ElasticConnector(create_es_connector_config(source_es_params, threads))
+        es_source = ElasticRangedIndexer(es_source_conn, source_es_params['index-name'],
+                                         scan_slices=batch_params.get('scan-slices', 1))
 
         # initialize NLP service
-        nlp_service = NlpService(config.params['nlp-service']['endpoint-url'],
-          endpoint_request_mode=config.params['nlp-service']['endpoint-request-mode'],
-          use_bulk_indexing=config.params['nlp-service']['use-bulk-indexing'],
-          username=config.params['nlp-service']['credentials']['username'],
-          password=config.params['nlp-service']['credentials']['password'],
-          max_number_of_retries=config.params['nlp-service']['max-retries-on-failure'])
+        nlp_service = NlpService(nlp_params['endpoint-url'],
+          endpoint_request_mode=nlp_params.get('endpoint-request-mode') or "",
+          use_bulk_indexing=nlp_params.get('use-bulk-indexing', True),
+          username=nlp_credentials.get('username'),
+          password=nlp_credentials.get('password'),
+          max_number_of_retries=nlp_params.get('max-retries-on-failure', 1),
+          bulk_url_endpoint=nlp_params.get('bulk-endpoint-url'),
+          pool_size=threads,
+          compress_requests=nlp_params.get('compress-requests', False),
+          read_timeout=nlp_params.get('read-timeout', 600))
 
         # initialize the elastic sink
-        sink_params = config.params['sink']
+        es_sink_conn = ElasticConnector(create_es_connector_config(sink_es_params, threads))
+        # the settings of the indices receiving the annotations, during and after the bulk ingestion
+        es_sink = ElasticIndexer(es_sink_conn, sink_es_params['index-name'],
+                                 bulk_settings=sink_mapping.get('bulk-index-settings'),
+                                 steady_settings=sink_mapping.get('steady-index-settings'),
+                                 force_merge_segments=sink_mapping.get('bulk-force-merge-segments'))
 
-        sink_credentials = sink_params['es']['credentials'] if sink_params['es']['credentials'] else None
-        sink_extra_params = sink_params['es']['extra-params'] if sink_params['es']['extra-params'] else None
-        sink_security = sink_params['es']['security']  if sink_params['es']['security'] else None
-
-        sink_ssl_config = SslConnectionConfig(ca_file_path=sink_security['ca-file-path'],
-                                              ca_certs_path=sink_security['ca-certs-path'],
-                                              client_cert_path=sink_security['client-cert-path'],
-                                              client_key_path=sink_security['client-key-path'])
-
-        es_sink_conf =  ElasticConnectorConfig(hosts=sink_params['es']['hosts'], credentials=sink_credentials, extra_params=sink_extra_params,
-                                                   ssl_config=sink_ssl_config)
-
-        es_sink_conn = ElasticConnector(es_sink_conf)
-        es_sink = ElasticIndexer(es_sink_conn, sink_params['es']['index-name'])
+        # check whether we can actually connect to ElasticSearch, once all the connectors are created
+        ElasticConnector.check_health()
 
         # initialize the indexer
-        mapping = config.params['mapping']
         annoation_indexer_config = AnnotationIndexerConfig(nlp_service=nlp_service,
                                           source_indexer=es_source,
-                                          source_text_field=mapping['source']['text-field'],
-                                          source_docid_field=mapping['source']['docid-field'],
-                                          source_fields_to_persist=mapping['source']['persist-fields'],
+                                          source_text_field=source_mapping['text-field'],
+                                          source_docid_field=source_mapping['docid-field'],
+                                          source_fields_to_persist=source_mapping.get('persist-fields') or [],
                                           sink_indexer=es_sink,
-                                          split_index_by_field=mapping['sink']['split-index-by-field'],
-                                          source_batch_date_field=mapping['source']['batch']['date-field'],
-                                          batch_date_format=mapping['source']['batch']['date-format'],
-                                          skip_doc_check=mapping['nlp']['skip-processed-doc-check'],
-                                          nlp_ann_id_field=mapping['nlp']['annotation-id-field'],
-                                          threads=mapping['source']['batch']['threads'],
-                                          python_date_format=mapping['source']['batch']['python-date-format'],
-                                          interval=mapping['source']['batch']['interval'],
-                                          same_index_ingest=mapping['index-ingest-mode']['same-index'],
-                                          use_nested_objects=mapping['index-ingest-mode']['use-nested-objects'],
-                                          es_nested_object_schema_mapping=mapping['index-ingest-mode']['es-nested-object-schema-mapping'])
+                                          split_index_by_field=sink_mapping.get('split-index-by-field') or "",
+                                          source_batch_date_field=batch_params['date-field'],
+                                          batch_date_format=batch_params.get('date-format', "yyyy-MM-dd"),
+                                          skip_doc_check=nlp_mapping.get('skip-processed-doc-check', False),
+                                          nlp_ann_id_field=nlp_mapping.get('annotation-id-field', "id"),
+                                          threads=threads,
+                                          queue_size=queue_size,
+                                          python_date_format=batch_params.get('python-date-format', '%Y-%m-%d'),
+                                          interval=batch_params.get('interval', 30),
+                                          interval_target_docs=batch_params.get('interval-target-docs', 0),
+                                          same_index_ingest=ingest_mode.get('same-index', False),
+                                          use_nested_objects=ingest_mode.get('use-nested-objects', False),
+                                          es_nested_object_schema_mapping=ingest_mode.get('es-nested-object-schema-mapping') or "",
+                                          bulk_chunk_size=sink_mapping.get('bulk-chunk-size', 500),
+                                          bulk_max_chunk_bytes=sink_mapping.get('bulk-max-chunk-bytes', 50 * 1024 * 1024),
+                                          bulk_queue_size=sink_mapping.get('bulk-queue-size', 4),
+                                          nlp_batch_size=nlp_params.get('batch-size', 1),
+                                          nlp_min_tokens=nlp_mapping.get('min-tokens', 0),
+                                          nlp_content_regex=nlp_mapping.get('content-regex') or "",
+                                          nlp_cache_size=nlp_mapping.get('cache-size', 1000))
                                           
         indexer = BatchAnnotationsIndexer(annoation_indexer_config)
 
@@ -123,8 +188,7 @@ if __name__ == "__main__":
         exit(1)
 
     # set up the Elastic logger to be more verbose and run the indexer
-    logging.getLogger('elasticsearch').setLevel(int(config.params['logging-level']))
+    logging.getLogger('elasticsearch').setLevel(logging_level)
     
-    indexer.index_range(batch_date_start=mapping['source']['batch']['date-start'],
-                        batch_date_end=mapping['source']['batch']['date-end'])
-
+    indexer.index_range(batch_date_start=batch_params['date-start'],
+                        batch_date_end=batch_params['date-end'])
@@ -1,19 +1,23 @@
 #!/usr/bin/python
 
-from ingester.utils import remove_duplicate_records
+from ingester.utils import remove_duplicate_records, chunked
 from ingester.nlp_service import NlpService
 from ingester.es_common import ElasticIndexer, ElasticRangedIndexer
+from ingester.es_schemas import SCHEMA_MAPPINGS
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, time
+import os
+import queue
+import threading
+import hashlib
+from collections import OrderedDict, defaultdict
+from datetime import datetime
 from datetime import timedelta
 
 from dataclasses import dataclass
 
-import json
-import ast
 import re
 import itertools
+import contextlib
 
 @dataclass
 class AnnotationIndexerConfig:
@@ -28,6 +32,18 @@ class AnnotationIndexerConfig:
         :param split_index_by_field: optional, the name of the field by which the sink index should be split
         :param skip_doc_check: optional, whether to skip checking for already ingested documents
         :param nlp_ann_id_field: optional, the name of the annotation id field
+        :param threads: optional, the number of threads processing the documents
+        :param queue_size: optional, the maximum number of documents waiting to be processed by the threads
+        :param bulk_chunk_size: optional, the maximum number of annotations sent in a single bulk request,
+                                should not exceed bulk_max_chunk_bytes / average annotation size
+        :param bulk_max_chunk_bytes: optional, the maximum size of a single bulk request (in bytes)
+        :param bulk_queue_size: optional, the number of bulk requests waiting for the bulk threads
+        :param nlp_batch_size: optional, the number of documents sent together to the NLP service
+        :param nlp_min_tokens: optional, the minimum number of tokens (space separated) in the text to query the NLP service
+        :param nlp_content_regex: optional, the regular expression the text must match to query the NLP service
+        :param nlp_cache_size: optional, the number of NLP service responses cached by the text, 0 to disable caching
+        :param interval_target_docs: optional, the number of documents per date interval to adapt the interval to,
+                                     0 to keep the interval fixed
     """
      
     nlp_service : NlpService = None
@@ -38,6 +54,7 @@ class AnnotationIndexerConfig:
     sink_indexer : ElasticIndexer = None
     split_index_by_field : str = ""
     threads : int = 4
+    queue_size : int = 8
     skip_doc_check : bool = False
     nlp_ann_id_field : str = "id"
     python_date_format : str = '%Y-%m-%d'
@@ -47,6 +64,14 @@ class AnnotationIndexerConfig:
     same_index_ingest : bool = False
     use_nested_objects : bool = False
     es_nested_object_schema_mapping : str = ""
+    bulk_chunk_size : int = 500
+    bulk_max_chunk_bytes : int = 50 * 1024 * 1024
+    bulk_queue_size : int = 4
+    nlp_batch_size : int = 1
+    nlp_min_tokens : int = 0
+    nlp_content_regex : str = ""
+    nlp_cache_size : int = 1000
+    interval_target_docs : int = 0
 
 ################################
 #
@@ -65,17 +90,147 @@ class AnnotationsIndexer:
     # minimum length of the text field that will be sen to ElasticSearch
     MIN_TEXT_LEN = 5
 
+    # the maximum number of documents checked for being already processed in a single lookup
+    PROCESSED_CHECK_MAX_DOCS = 10000
+
+    # the number of queued documents after which the progress is logged
+    QUEUED_DOCS_LOG_INTERVAL = 10000
+
     def __init__(self, annotation_indexer_config : AnnotationIndexerConfig = AnnotationIndexerConfig()):
 
         self.annotation_indexer_config = annotation_indexer_config
 
+        # serializing the bulk requests is CPU-bound, hence there is no gain in more bulk threads than CPUs
+        self.bulk_thread_count = min(self.annotation_indexer_config.threads, os.cpu_count() or 1)
+
+        # the names of the source document fields persisted with the annotations, refined once
+        self.fields_to_persist = [(field, self.FIELD_META_PREFIX + "." + field)
+                                  for field in self.annotation_indexer_config.source_fields_to_persist or []]
+
+        self.nlp_content_re = re.compile(self.annotation_indexer_config.nlp_content_regex) \
+            if self.annotation_indexer_config.nlp_content_regex else None
+
+        # the NLP service responses keyed by the text digest, in the least recently used order
+        self.nlp_cache = OrderedDict()
+        self.nlp_cache_lock = threading.Lock()
+        self.nlp_cache_hits = 0
+        self.nlp_cache_misses = 0
+
+        # the queue of the bulk actions shared by all the workers, only available while processing the documents
+        self.actions_queue = None
+
         self.log = logging.getLogger(self.__class__.__name__)
      
     def _get_doc_ids(self):
         """
-        Returns the document IDs to be processed
+        Returns the generator of document IDs to be processed
+        """
+        return self.annotation_indexer_config.source_indexer.iter_doc_ids_scan()
+
+    def _get_source_fields(self):
+        """
+        Returns the source document fields required for processing and ingesting the annotations
+        """
+        fields = [self.annotation_indexer_config.source_text_field, self.annotation_indexer_config.source_docid_field]
+        if self.annotation_indexer_config.source_fields_to_persist:
+            fields.extend(self.annotation_indexer_config.source_fields_to_persist)
+        if self.annotation_indexer_config.same_index_ingest:
+            fields.append("annotations")
+        return list(dict.fromkeys(fields))
+
+    def _process_documents(self, docs):
+        """
+        Processes the stream of documents by the worker threads fed through a bounded queue,
+        so that reading the documents is back-pressured by the processing instead of buffering them all
+        :param docs: the iterable of (document id, document) pairs, the document is fetched
+                     from the source when not provided
+        :return: the number of documents processed
         """
-        return self.annotation_indexer_config.source_indexer.get_doc_ids_scan()
+        # the documents are queued in groups sent together to the NLP service, the queue size is kept in documents
+        nlp_batch_size = max(1, self.annotation_indexer_config.nlp_batch_size)
+        docs_queue = queue.Queue(maxsize=max(1, self.annotation_indexer_config.queue_size // nlp_batch_size))
+
+        # the documents are read ahead of the queue only to check for the processed ones in a single lookup,
+        # at most as many as the queue holds, so that the queue size still bounds the buffered documents
+        check_in_bulk = self._can_check_processed_in_bulk()
+        docs_batch_size = nlp_batch_size
+        if check_in_bulk:
+            check_batch_size = min(self.PROCESSED_CHECK_MAX_DOCS, self.annotation_indexer_config.queue_size)
+            docs_batch_size = max(1, check_batch_size // nlp_batch_size) * nlp_batch_size
+
+        def worker():
+            while True:
+                docs_group = docs_queue.get()
+                if docs_group is None:
+                    return
+                try:
+                    self._process_document_group(docs_group, check_processed=not check_in_bulk)
+                except Exception as e:
+                    self.log.error(repr(e))
+
+        # the annotations of all the documents are sent through a single shared bulk stream, so that
+        # the bulk requests are filled up regardless of the number of annotations per document
+        self.actions_queue = queue.Queue(maxsize=self.annotation_indexer_config.bulk_chunk_size * max(1, self.annotation_indexer_config.bulk_queue_size))
+        bulk_consumer = threading.Thread(target=self._consume_actions, args=(self.actions_queue,), daemon=True)
+        bulk_consumer.start()
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(self.annotation_indexer_config.threads)]
+        for thread in workers:
+            thread.start()
+
+        total_docs = 0
+        try:
+            for docs_batch in chunked(docs, docs_batch_size):
+                if (total_docs + len(docs_batch)) // self.QUEUED_DOCS_LOG_INTERVAL > total_docs // self.QUEUED_DOCS_LOG_INTERVAL:
+                    self.log.info('Queued documents: %d' % (total_docs + len(docs_batch)))
+                total_docs += len(docs_batch)
+
+                if check_in_bulk:
+                    docs_batch = self._skip_processed_docs(docs_batch)
+
+                for docs_group in chunked(docs_batch, nlp_batch_size):
+                    docs_queue.put(docs_group)
+        finally:
+            # signal the workers to finish once the queued documents are processed
+            for _ in workers:
+                docs_queue.put(None)
+            for thread in workers:
+                thread.join()
+
+            # flush the remaining bulk actions
+            self.actions_queue.put(None)
+            bulk_consumer.join()
+            self.actions_queue = None
+
+        return total_docs
+
+    def _consume_actions(self, actions_queue):
+        """
+        Sends the bulk actions put on the queue by the workers to the sink, until the None sentinel is received
+        """
+        finished = False
+
+        def actions():
+            nonlocal finished
+            while True:
+                action = actions_queue.get()
+                if action is None:
+                    finished = True
+                    return
+                yield action
+
+        try:
+            self.annotation_indexer_config.sink_indexer.index_docs_bulk_gen(actions(),
+                                                                            thread_count=self.bulk_thread_count,
+                                                                            chunk_size=self.annotation_indexer_config.bulk_chunk_size,
+                                                                            max_chunk_bytes=self.annotation_indexer_config.bulk_max_chunk_bytes,
+                                                                            queue_size=self.annotation_indexer_config.bulk_queue_size)
+        except Exception as e:
+            self.log.error(repr(e))
+        finally:
+            # keep draining the queue, so that the workers never block on a stopped consumer
+            while not finished:
+                finished = actions_queue.get() is None
 
     def _document_already_processed(self, doc):
         """
@@ -83,7 +238,7 @@ class AnnotationsIndexer:
         """
      
         if self.annotation_indexer_config.same_index_ingest:
-            if "annotations" in list(doc.keys()):
+            if "annotations" in doc:
                 if len(doc["annotations"]) > 0:
                     return True
             return False
@@ -100,202 +255,314 @@ class AnnotationsIndexer:
 
             return self.annotation_indexer_config.sink_indexer.doc_exists(match_criteria=match_criteria, index_suffix=suffix)
 
-    def _index_annotations(self, annotations, document, src_doc_id):
+    def _can_check_processed_in_bulk(self):
         """
-        Indexes the annotations provided in the NLP Service response
+        Checks whether the already processed documents can be looked up in bulk by their source ids
+        instead of checking each fetched document separately
         """
-        updated_annotations = []
-        updated_annotations.extend(annotations.values())
-        
-        if "annotations" in document.keys():
-          updated_annotations.extend(document["annotations"])
+        return self.annotation_indexer_config.skip_doc_check and \
+            not self.annotation_indexer_config.same_index_ingest
 
-        if self.annotation_indexer_config.same_index_ingest:
-            self.annotation_indexer_config.source_indexer.conn.es.update(index=self.annotation_indexer_config.source_indexer.get_index_name(),
-             body = {"doc" : {"annotations" : updated_annotations}})
-        elif self.annotation_indexer_config.use_nested_objects:
-          document["annotations"] = updated_annotations
-          self.annotation_indexer_config.sink_indexer.index_doc(document, doc_id=src_doc_id + "_annotations")
-        else:
-            for ann in annotations:
-                # update annotation entry with fields from the document t4o persist and with prefix
-                refined_ann = {}
-                if self.annotation_indexer_config.source_fields_to_persist:
-                  for field in self.annotation_indexer_config.source_fields_to_persist:
-                    if field in document:
-                        refined_field = "%s.%s" % (self.FIELD_META_PREFIX, field)
-                        refined_ann[refined_field] = document[field]
-
-                # update annotation entry with fields from the annotation with prefix
-                for field, value in ann.items():
-                    refined_field = "%s.%s" % (self.FIELD_ANN_PREFIX, field)
-                    refined_ann[refined_field] = value
-
-                # index the refined annotation
-                if len(self.annotation_indexer_config.split_index_by_field) > 0 and self.annotation_indexer_config.split_index_by_field in ann:
-                    self.annotation_indexer_config.sink_indexer.index_doc(doc=refined_ann, index_suffix=ann[self.annotation_indexer_config.split_index_by_field])
-                else:
-                    self.annotation_indexer_config.sink_indexer.index_doc(refined_ann)
+    def _get_processed_doc_ids(self, doc_ids):
+        """
+        Returns the subset of the source document ids that have been possibly already processed
+        """
+        suffix = "*" if len(self.annotation_indexer_config.split_index_by_field) > 0 else ""
+        field_name = "%s.%s" % (self.FIELD_META_PREFIX, self.annotation_indexer_config.source_docid_field)
+
+        return self.annotation_indexer_config.sink_indexer.existing_ids(doc_ids, id_field=field_name, index_suffix=suffix)
+
+    def _skip_processed_docs(self, docs_batch):
+        """
+        Filters out the documents that have been possibly already processed, using a single lookup for the whole batch
+        :param docs_batch: the list of (document id, document) pairs
+        :return: the list of (document id, document) pairs still to be processed
+        """
+        docid_field = self.annotation_indexer_config.source_docid_field
+
+        if docid_field != "_id":
+            # the source document id is stored in the document itself, hence the missing documents are fetched up-front
+            missing_doc_ids = [doc_id for doc_id, doc in docs_batch if doc is None]
+            if missing_doc_ids:
+                fetched_docs = {doc["_id"]: doc for doc in self.annotation_indexer_config.source_indexer.get_docs(missing_doc_ids, fields=self._get_source_fields())}
+                docs_batch = [(doc_id, doc if doc is not None else fetched_docs.get(doc_id)) for doc_id, doc in docs_batch]
+
+        def source_doc_id(item):
+            doc_id, doc = item
+            if docid_field == "_id":
+                return doc_id
+            return doc.get(docid_field) if isinstance(doc, dict) else None
+
+        source_doc_ids = [source_doc_id(item) for item in docs_batch]
+        processed_doc_ids = self._get_processed_doc_ids([doc_id for doc_id in source_doc_ids if doc_id is not None])
+        if not processed_doc_ids:
+            return docs_batch
+
+        self.log.info('Skipping already processed documents: %d' % len(processed_doc_ids))
+        return [item for item, doc_id in zip(docs_batch, source_doc_ids) if doc_id is None or doc_id not in processed_doc_ids]
 
     def _prepare_annotations(self, annotations_entities, document, src_doc_id):
         """
             Returns a generator to create annotation documents -- used for ES bulk indexing
         """
         # if we choose to ingest back into the same index we create an extra field
-        refined_annotations = []
-        refined_annotations.extend(annotations_entities.values())
-
+        # the arrays are replaced as a whole by the partial document updates, hence no script is needed to overwrite the annotations
         if self.annotation_indexer_config.same_index_ingest:
           
           # check if document has annotations already
-          if "annotations" in document.keys():
-            refined_annotations.extend(document["annotations"])
-            refined_annotations = remove_duplicate_records(refined_annotations)
+          if "annotations" in document:
+            refined_annotations = remove_duplicate_records(itertools.chain(annotations_entities.values(), document["annotations"]))
+          else:
+            refined_annotations = list(annotations_entities.values())
 
           operation = {
                   "_id": src_doc_id,
                   "_op_type": "update",
-                  "script" : {
-                      "lang": "painless",
-                      "source" : "ctx._source.annotations = new ArrayList(); ctx._source.annotations = params.annotations",
-                      "params" : {"annotations" : refined_annotations}
-                  },
+                  "doc" : {"annotations" : refined_annotations},
                   "_index" : self.annotation_indexer_config.source_indexer.get_index_name()
               }
           yield operation
         elif self.annotation_indexer_config.use_nested_objects:
             ann_doc_id = "doc_" + str(document[self.annotation_indexer_config.source_docid_field]) + "_annotations"
-            already_exists = self.annotation_indexer_config.sink_indexer.doc_exists({"_id": ann_doc_id})
-
-            if already_exists:
-              ann_doc = self.annotation_indexer_config.sink_indexer.get_doc(ann_doc_id)
-              
-              if "annotations" in ann_doc.keys():
-                refined_annotations.extend(ann_doc["annotations"])
-                refined_annotations = remove_duplicate_records(refined_annotations)
+            ann_doc = self.annotation_indexer_config.sink_indexer.get_doc(ann_doc_id, ignore_missing=True)
+
+            if ann_doc is not None and "annotations" in ann_doc:
+                refined_annotations = remove_duplicate_records(itertools.chain(annotations_entities.values(), ann_doc["annotations"]))
                 operation = {
                   "_id": ann_doc_id,
                   "_op_type":  'update',
-                  "script" : {
-                      "lang": "painless",
-                      "source" : "ctx._source.annotations = new ArrayList(); ctx._source.annotations = params.annotations",
-                      "params" : {"annotations" : refined_annotations}
-                  },
+                  "doc" : {"annotations" : refined_annotations},
                   "_index" : self.annotation_indexer_config.sink_indexer.get_index_name()
                 }
             else:
-              fields_to_persist = {}
-              if self.annotation_indexer_config.source_fields_to_persist:
-                for field in self.annotation_indexer_config.source_fields_to_persist:
-                  if field in document.keys():
-                      refined_field = "%s.%s" % (self.FIELD_META_PREFIX, field)
-                      fields_to_persist[refined_field] = document[field]
+              fields_to_persist = self._get_fields_to_persist(document)
 
               operation = {
                       "_id": ann_doc_id,
                       "_op_type":  'index',
-                      "_source" : {"annotations" : refined_annotations, **fields_to_persist},
+                      "_source" : {"annotations" : list(annotations_entities.values()), **fields_to_persist},
                       "_index" : self.annotation_indexer_config.sink_indexer.get_index_name()
               }
             yield operation
         else:
-          for index, entity in annotations_entities.items():
-              refined_ann = {}
-              if self.annotation_indexer_config.source_fields_to_persist:
-                for field in self.annotation_indexer_config.source_fields_to_persist:
-                  if field in document:
-                      refined_field = "%s.%s" % (self.FIELD_META_PREFIX, field)
-                      refined_ann[refined_field] = document[field]
-
-              for field, value in entity.items():
-                  refined_field = "%s.%s" % (self.FIELD_ANN_PREFIX, field)
-                  refined_ann[refined_field] = value
-
-              if len(self.annotation_indexer_config.split_index_by_field) > 0:
-                  index_suffix = entity[self.annotation_indexer_config.split_index_by_field]
-                  index_name = self.annotation_indexer_config.sink_indexer.get_index_name(index_suffix)
-              else:
-                  index_name = self.annotation_indexer_config.sink_indexer.get_index_name()
-
-              operation = {
-                  '_id': "doc-%s-ann-%s" % (document[self.annotation_indexer_config.source_docid_field], entity[self.annotation_indexer_config.nlp_ann_id_field]),
-                  '_op_type': 'index',
-                  '_index': index_name,
-                  '_source': refined_ann
-              }
-
-              yield operation
+          # the values shared by all the annotations of the document are computed only once
+          sink_indexer = self.annotation_indexer_config.sink_indexer
+          split_index_by_field = self.annotation_indexer_config.split_index_by_field
+          nlp_ann_id_field = self.annotation_indexer_config.nlp_ann_id_field
+          fields_to_persist = self._get_fields_to_persist(document)
+          ann_field_prefix = self.FIELD_ANN_PREFIX + "."
+          ann_id_prefix = "doc-%s-ann-" % document[self.annotation_indexer_config.source_docid_field]
+
+          # when skipping the processed documents, the annotations already indexed by an interrupted run are kept
+          # with `create` actions, letting ElasticSearch reject them cheaply instead of replacing them
+          op_type = 'create' if self.annotation_indexer_config.skip_doc_check else 'index'
+
+          # group the annotations by the index they are sent to, so that the index name is computed once per group
+          if split_index_by_field:
+              entities_by_suffix = defaultdict(list)
+              for entity in annotations_entities.values():
+                  entities_by_suffix[entity.get(split_index_by_field)].append(entity)
+          else:
+              entities_by_suffix = {None: annotations_entities.values()}
+
+          for index_suffix, entities in entities_by_suffix.items():
+              # the static part of the bulk action, shared by all the annotations going to the same index
+              index_name = sink_indexer.get_index_name(index_suffix) if index_suffix is not None else sink_indexer.get_index_name()
+              base_action = {'_op_type': op_type, '_index': index_name}
+
+              for entity in entities:
+                  refined_ann = dict(fields_to_persist)
+                  refined_ann.update((ann_field_prefix + field, value) for field, value in entity.items())
+
+                  yield {**base_action, '_id': ann_id_prefix + str(entity[nlp_ann_id_field]), '_source': refined_ann}
+
+    def _get_fields_to_persist(self, document):
+        """
+        Returns the source document fields to be stored along with the annotations, with the refined names
+        """
+        return {refined_field: document[field] for field, refined_field in self.fields_to_persist if field in document}
 
     def _index_annotations_bulk(self, annotations, document, src_doc_id):
         """
         Indexes the annotations provided in the NLP Service response (bulk version)
+        The annotations are added to the shared bulk stream while processing the documents, sent on their own otherwise
         """
-        self.annotation_indexer_config.sink_indexer.index_docs_bulk_gen(self._prepare_annotations(annotations, document, src_doc_id))
+        if self.actions_queue is not None:
+            for action in self._prepare_annotations(annotations, document, src_doc_id):
+                self.actions_queue.put(action)
+            return
 
-    def _process_document(self, src_doc_id):
+        self.annotation_indexer_config.sink_indexer.index_docs_bulk_gen(self._prepare_annotations(annotations, document, src_doc_id),
+                                                                        thread_count=self.bulk_thread_count,
+                                                                        chunk_size=self.annotation_indexer_config.bulk_chunk_size,
+                                                                        max_chunk_bytes=self.annotation_indexer_config.bulk_max_chunk_bytes,
+                                                                        queue_size=self.annotation_indexer_config.bulk_queue_size)
+
+    def _has_content(self, doc):
         """
-        Performs full document processing cycle for the specified document id
+        Checks whether there is document content to process
+        """
+        if not isinstance(doc, dict):
+            return False
+        text = doc.get(self.annotation_indexer_config.source_text_field)
+        return text is not None and len(text) >= self.MIN_TEXT_LEN
+
+    def _index_nlp_response(self, nlp_response, doc, src_doc_id):
+        """
+        Extracts the annotations from the NLP service response and indexes them
         """
+        if not isinstance(nlp_response, dict):
+            self.log.error(" - no result payload returned from NLP service")
+            return
 
-        self.log.info('Processing document with id: ' + src_doc_id)
-        doc = self.annotation_indexer_config.source_indexer.get_doc(src_doc_id)
+        if "result" in nlp_response:
+          result = nlp_response["result"]
 
+          if not isinstance(result, dict) or not isinstance(result.get('annotations'), dict):
+            self.log.error(" - no annotations available in the NLP result payload")
+            return 
 
-        # check whether there is document content to process
-        if (isinstance(doc, dict) and (self.annotation_indexer_config.source_text_field not in doc.keys() or doc[self.annotation_indexer_config.source_text_field] is None)) or \
-          len(doc[self.annotation_indexer_config.source_text_field]) < self.MIN_TEXT_LEN:
-            self.log.info('- skipping: no content')
+          result = result['annotations'].get('entities')
+          if result is None:
+            self.log.error(" - no annotation entities available in the NLP result payload")
             return
-        
-        try:
-            # check whether the document has been already processed
-            if self.annotation_indexer_config.skip_doc_check and self._document_already_processed(doc):
-                self.log.info('doc id : ' + str(src_doc_id) + ' - skipping: document already processed')
-                return
-         
-            # get the text
-            doc_text = doc[self.annotation_indexer_config.source_text_field]
     
-            # query the NLP service and retrieve back the annotations
-            self.log.info('- querying the NLP service')
-            
-            nlp_response = self.annotation_indexer_config.nlp_service.query(text=doc_text)
+        elif "entities" in nlp_response:
+          # Entities are present alone only when using GATE-NLP MODE ENDPOINT
+          result = nlp_response["entities"]
+          if result is None:
+            self.log.error(" - no annotation entities available in the NLP result payload")
+            return
 
-            self.log.info("Finished processing NLP for document with id: " + src_doc_id)
+        else:
+            self.log.error(" - no result payload returned from NLP service")
+            return
 
-            if "result" in nlp_response.keys():
-              result = nlp_response["result"]
+        self._index_annotations_bulk(result, doc, src_doc_id)
 
-              if 'annotations' not in result.keys() or result['annotations'] is None or result is None:
-                self.log.error(" - no annotations available in the NLP result payload")
-                return 
+    def _query_unique_texts(self, texts):
+        """
+        Queries the NLP service for the texts, sending the identical texts only once
+        :param texts: the texts to be processed
+        :return: the (NLP service response, whether all the endpoints responded) pairs, in the order of the texts
+        """
+        unique_texts = list(dict.fromkeys(texts))
+        if len(unique_texts) == len(texts):
+            return self.annotation_indexer_config.nlp_service.query_batch_with_status(texts=texts)
 
-              if 'entities' not in result["annotations"].keys() or result["annotations"]["entities"] is None :
-                self.log.error(" - no annotation entities available in the NLP result payload")
-                return
+        self.log.info('- skipping duplicated texts: %d' % (len(texts) - len(unique_texts)))
+        responses = dict(zip(unique_texts, self.annotation_indexer_config.nlp_service.query_batch_with_status(texts=unique_texts)))
+        return [responses[text] for text in texts]
 
-              result = result['annotations']['entities']
-        
-            elif "entities" in nlp_response.keys():
-              # Entities are present alone only when using GATE-NLP MODE ENDPOINT
-              if nlp_response["entities"] is not None:
-                result = nlp_response["entities"]
-              else:
-                self.log.error(" - no annotation entities available in the NLP result payload")
-                return
-
-            elif "result" not in nlp_response.keys() or "entities" not in nlp_response.keys():
-                self.log.error(" - no result payload returned from NLP service")
-                return
-
-            if self.annotation_indexer_config.nlp_service.use_bulk_indexing:
-                self._index_annotations_bulk(result, doc, src_doc_id)
-            else:
-                self._index_annotations(result, doc, src_doc_id)
-           
-        except Exception as e:
-            self.log.error(repr(e))
-      
+    def _query_nlp_service(self, texts):
+        """
+        Queries the NLP service for the texts, reusing the cached responses for the texts already processed
+        :param texts: the texts to be processed
+        :return: the NLP service responses, in the order of the texts
+        """
+        cache_size = self.annotation_indexer_config.nlp_cache_size
+        if cache_size <= 0:
+            return [nlp_response for nlp_response, _ in self._query_unique_texts(texts)]
+
+        keys = [hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest() for text in texts]
+        nlp_responses = [None] * len(texts)
+
+        with self.nlp_cache_lock:
+            for i, key in enumerate(keys):
+                if key in self.nlp_cache:
+                    self.nlp_cache.move_to_end(key)
+                    nlp_responses[i] = self.nlp_cache[key]
+
+            missing = [i for i, nlp_response in enumerate(nlp_responses) if nlp_response is None]
+            self.nlp_cache_hits += len(texts) - len(missing)
+            self.nlp_cache_misses += len(missing)
+
+        if len(missing) < len(texts):
+            self.log.info('- using cached NLP responses: %d' % (len(texts) - len(missing)))
+        if not missing:
+            return nlp_responses
+
+        queried_responses = self._query_unique_texts([texts[i] for i in missing])
+
+        with self.nlp_cache_lock:
+            for i, (nlp_response, complete) in zip(missing, queried_responses):
+                nlp_responses[i] = nlp_response
+                # only the responses of all the endpoints are cached, so that the failed documents are requested again
+                # instead of reusing the annotations of the endpoints that responded
+                if nlp_response and complete:
+                    self.nlp_cache[keys[i]] = nlp_response
+                    if len(self.nlp_cache) > cache_size:
+                        self.nlp_cache.popitem(last=False)
+
+        return nlp_responses
+
+    def _process_document_group(self, docs_group, check_processed=True):
+        """
+        Performs full document processing cycle for the group of documents, querying the NLP service
+        for all the documents of the group at once
+        :param docs_group: the list of (document id, document) pairs, the documents not provided
+                           are fetched from the source in a single request
+        :param check_processed: whether to check each document separately if it has been already processed,
+                                not needed when the check has been done for the whole batch
+        """
+        missing_doc_ids = [src_doc_id for src_doc_id, doc in docs_group if doc is None]
+        if missing_doc_ids:
+            fetched_docs = {doc["_id"]: doc for doc in self.annotation_indexer_config.source_indexer.get_docs(missing_doc_ids, fields=self._get_source_fields())}
+            docs_group = [(src_doc_id, doc if doc is not None else fetched_docs.get(src_doc_id)) for src_doc_id, doc in docs_group]
+
+        docs_to_process = []
+        for src_doc_id, doc in docs_group:
+            self.log.info('Processing document with id: ' + src_doc_id)
+
+            if not self._has_content(doc):
+                self.log.info('- skipping: no content')
+                continue
+
+            # avoid querying the NLP service for the texts that cannot contain the entities of interest
+            text = doc[self.annotation_indexer_config.source_text_field]
+            if self.annotation_indexer_config.nlp_min_tokens > 0 and \
+                    text.count(" ") + 1 < self.annotation_indexer_config.nlp_min_tokens:
+                self.log.info('- skipping: too few tokens')
+                continue
+
+            if self.nlp_content_re is not None and self.nlp_content_re.search(text) is None:
+                self.log.info('- skipping: content not matching')
+                continue
+
+            try:
+                # check whether the document has been already processed
+                if self.annotation_indexer_config.skip_doc_check and check_processed and \
+                        self._document_already_processed(doc):
+                    self.log.info('doc id : ' + str(src_doc_id) + ' - skipping: document already processed')
+                    continue
+            except Exception as e:
+                self.log.error(repr(e))
+                continue
+
+            docs_to_process.append((src_doc_id, doc))
+
+        if not docs_to_process:
+            return
+
+        # query the NLP service and retrieve back the annotations
+        self.log.info('- querying the NLP service')
+        texts = [doc[self.annotation_indexer_config.source_text_field] for _, doc in docs_to_process]
+        nlp_responses = self._query_nlp_service(texts)
+
+        for (src_doc_id, doc), nlp_response in zip(docs_to_process, nlp_responses):
+            self.log.info("Finished processing NLP for document with id: " + src_doc_id)
+            try:
+                self._index_nlp_response(nlp_response, doc, src_doc_id)
+            except Exception as e:
+                self.log.error(repr(e))
+
+    def _process_document(self, src_doc_id, doc=None):
+        """
+        Performs full document processing cycle for the specified document id
+        :param src_doc_id: the id of the source document
+        :param doc: optional, the already retrieved source document, fetched by the id if not provided
+        """
+        self._process_document_group([(src_doc_id, doc)])
 
     def index(self):
         """
@@ -304,12 +571,9 @@ class AnnotationsIndexer:
         :param: source_date_end: the end date of documents to process
         """
         self.log.info('Fetching document ids that match the criteria...')
-        doc_ids = self._get_doc_ids()
+        total_docs = self._process_documents((doc_id, None) for doc_id in self._get_doc_ids())
 
-        self.log.info('Found documents: %d' % len(doc_ids))
-
-        with ThreadPoolExecutor(max_workers=self.annotation_indexer_config.threads) as executor:
-            executor.map(self._process_document, doc_ids)
+        self.log.info('Found documents: %d' % total_docs)
 
 
 ################################
@@ -322,18 +586,52 @@ class BatchAnnotationsIndexer(AnnotationsIndexer):
     Performs: ES --> NLP Service --> ES indexing
     """
 
+    # the factor and the bounds (in days) of adapting the date interval to the density of the documents
+    INTERVAL_ADAPT_FACTOR = 2
+    MAX_INTERVAL_DAYS = 366
+
     def __init__(self, annotation_indexer_config):
         super().__init__(annotation_indexer_config)
 
+    def _adapt_interval(self, interval, total_docs):
+        """
+        Returns the date interval for the next segment, growing it over the sparse ranges and shrinking it
+        over the dense ones, so that each segment holds about the target number of documents
+        :param interval: the interval of the last segment, in days
+        :param total_docs: the number of documents found in the last segment
+        """
+        target_docs = self.annotation_indexer_config.interval_target_docs
+        if target_docs <= 0:
+            return interval
+
+        if total_docs < target_docs / self.INTERVAL_ADAPT_FACTOR:
+            interval = min(interval * self.INTERVAL_ADAPT_FACTOR, self.MAX_INTERVAL_DAYS)
+        elif total_docs > target_docs * self.INTERVAL_ADAPT_FACTOR:
+            interval = max(interval // self.INTERVAL_ADAPT_FACTOR, 1)
+
+        return interval
+
     def _get_doc_ids_range(self, source_date_start, source_date_end):
         """
-        Returns the document ids matching the specified range
+        Returns the generator of document ids matching the specified range
         """
-        return self.annotation_indexer_config.source_indexer.get_doc_ids_by_range_scan(date_field=self.annotation_indexer_config.source_batch_date_field,
+        return self.annotation_indexer_config.source_indexer.iter_doc_ids_by_range_scan(date_field=self.annotation_indexer_config.source_batch_date_field,
                                                              date_format=self.annotation_indexer_config.batch_date_format,
                                                              date_begin=source_date_start,
                                                              date_end=source_date_end)
 
+    def _get_docs_range(self, source_date_start, source_date_end):
+        """
+        Returns the generator of (document id, document) pairs matching the specified range,
+        the documents contain only the fields required for processing
+        """
+        docs = self.annotation_indexer_config.source_indexer.iter_docs_by_range_scan(date_field=self.annotation_indexer_config.source_batch_date_field,
+                                                                                   date_format=self.annotation_indexer_config.batch_date_format,
+                                                                                   date_begin=source_date_start,
+                                                                                   date_end=source_date_end,
+                                                                                   fields=self._get_source_fields())
+        return ((doc["_id"], doc) for doc in docs)
+
     def index_range(self, batch_date_start, batch_date_end):
         """
         Indexes the documents within the specified time range
@@ -356,506 +654,48 @@ class BatchAnnotationsIndexer(AnnotationsIndexer):
                           }
                       }
 
-        if self.annotation_indexer_config.es_nested_object_schema_mapping.lower() == "medcat-nested-object":
-          request_body = {
-              "properties": {
-                "annotations": {
-                  "type" : "nested",
-                  "properties": {
-                    "acc": {
-                      "type": "float"
-                    },
-                    "context_similarity": {
-                      "type": "float"
-                    },
-                    "cui": {
-                      "type": "text",
-                      "fields": {
-                        "keyword": {
-                          "type": "keyword",
-                          "ignore_above": 256
-                        }
-                      }
-                    },
-                    "detected_name": {
-                      "type": "text",
-                      "fields": {
-                        "keyword": {
-                          "type": "keyword",
-                          "ignore_above": 256
-                        }
-                      }
-                    },
-                    "end": {
-                      "type": "long"
-                    },
-                    "id": {
-                      "type": "long"
-                    },
-                    "meta_anns" : {
-                      "type" : "nested"
-                    },
-                    "pretty_name": {
-                      "type": "text",
-                      "fields": {
-                        "keyword": {
-                          "type": "keyword",
-                          "ignore_above": 256
-                        }
-                      }
-                    },
-                    "source_value": {
-                      "type": "text",
-                      "fields": {
-                        "keyword": {
-                          "type": "keyword",
-                          "ignore_above": 256
-                        }
-                      }
-                    },
-                    "start": {
-                      "type": "long"
-                    },
-                    "tuis": {
-                      "type": "text",
-                      "fields": {
-                        "keyword": {
-                          "type": "keyword",
-                          "ignore_above": 256
-                        }
-                      }
-                    },
-                    "types": {
-                      "type": "text",
-                      "fields": {
-                        "keyword": {
-                          "type": "keyword",
-                          "ignore_above": 256
-                        }
-                      }
-                    }
-                }
-                }
-              }
-            }
-      
-        if self.annotation_indexer_config.es_nested_object_schema_mapping.lower() == "gate-nlp-nested-object":
-            request_body = {
-                    "properties": {
-                      "annotations": {
-                        "type" : "nested",
-                        "properties": {
-                            "NMRule": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "firstName": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "gender": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "id": {
-                              "type": "long",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "indices": {
-                              "type": "long"
-                            },
-                            "initials": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "kind": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "matchedWithLonger": {
-                              "type": "boolean"
-                            },
-                            "matches": {
-                              "type": "long"
-                            },
-                            "orgType": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "orgType ": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "rule": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "rule ": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "ruleFinal": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "surname": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "title": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            },
-                            "type": {
-                              "type": "text",
-                              "fields": {
-                                "keyword": {
-                                  "type": "keyword",
-                                  "ignore_above": 256
-                                }
-                              }
-                            }
-                          }
-                      }
-                    }
-                  }
-
-        if self.annotation_indexer_config.es_nested_object_schema_mapping.lower() == "medcat-separate-index":
-          request_body = {
-            "properties": {
-                    "annotations": {
-                      "properties": {
-                        "acc": {
-                          "type": "float"
-                        },
-                        "context_similarity": {
-                          "type": "float"
-                        },
-                        "cui": {
-                          "type": "keyword",
-                          "ignore_above": 64
-                        },
-                        "detected_name": {
-                          "type": "text",
-                          "fields": {
-                            "keyword": {
-                              "type": "keyword",
-                              "ignore_above": 256
-                            }
-                          }
-                        },
-                        "end": {
-                          "type" : "keyword",
-                          "store" : "true",
-                          "index" : "false"
-                        },
-                        "id": {
-                          "type": "keyword"
-                        },
-                        "meta_anns": {
-                          "properties": {
-                            "Status": {
-                              "properties": {
-                                "confidence": {
-                                  "type": "float"
-                                },
-                                "name": {
-                                  "type": "text",
-                                  "fields": {
-                                    "keyword": {
-                                      "type": "keyword",
-                                      "ignore_above": 256
-                                    }
-                                  }
-                                },
-                                "value": {
-                                  "type": "text",
-                                  "fields": {
-                                    "keyword": {
-                                      "type": "keyword",
-                                      "ignore_above": 256
-                                    }
-                                  }
-                                }
-                              }
-                            }
-                          }
-                        },
-                        "pretty_name": {
-                          "type": "text",
-                          "fields": {
-                            "keyword": {
-                              "type": "keyword",
-                              "ignore_above": 256
-                            }
-                          }
-                        },
-                        "source_value": {
-                          "type": "text",
-                          "fields": {
-                            "keyword": {
-                              "type": "keyword",
-                              "ignore_above": 256
-                            }
-                          }
-                        },
-                        "start": {
-                          "type" : "keyword",
-                          "store" : "true",
-                          "index" : "false"
-                        },
-                        "tuis": {
-                          "type": "keyword",
-                          "ignore_above": 64
-                        },
-                        "types": {
-                          "type": "text",
-                          "fields": {
-                            "keyword": {
-                              "type": "keyword",
-                              "ignore_above": 256
-                            }
-                          }
-                        }
-                      }
-                    }
-                  }
-                }
-        
-        if self.annotation_indexer_config.es_nested_object_schema_mapping.lower() == "gate-nlp-separate-index":
-          request_body = {
-                        "properties": {
-                          "annotations": {
-                            "properties": {
-                              "NMRule": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "firstName": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "gender": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "id": {
-                                "type": "long",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "indices": {
-                                "type": "long"
-                              },
-                              "initials": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "kind": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "matchedWithLonger": {
-                                "type": "boolean"
-                              },
-                              "matches": {
-                                "type": "long"
-                              },
-                              "orgType": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "orgType ": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "rule": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "rule ": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "ruleFinal": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "surname": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "title": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              },
-                              "type": {
-                                "type": "text",
-                                "fields": {
-                                  "keyword": {
-                                    "type": "keyword",
-                                    "ignore_above": 256
-                                  }
-                                }
-                              }
-                            }
-                          }
-                        }
-                      }
+        schema_mapping = self.annotation_indexer_config.es_nested_object_schema_mapping.lower()
+        request_body = SCHEMA_MAPPINGS.get(schema_mapping, request_body)
 
         if self.annotation_indexer_config.same_index_ingest:
-          self.annotation_indexer_config.source_indexer.conn.es.indices.put_mapping(body=json.dumps(request_body), index=self.annotation_indexer_config.source_indexer.get_index_name())
+          # nothing to update when the annotations field is already mapped
+          if request_body:
+            self.annotation_indexer_config.source_indexer.put_mapping(request_body)
         elif  self.annotation_indexer_config.es_nested_object_schema_mapping != "":
-          if not self.annotation_indexer_config.sink_indexer.conn.es.indices.exists(index=self.annotation_indexer_config.sink_indexer.get_index_name()):
-            self.annotation_indexer_config.sink_indexer.conn.es.indices.create(index=self.annotation_indexer_config.sink_indexer.get_index_name())
-          self.annotation_indexer_config.sink_indexer.conn.es.indices.put_mapping(body=json.dumps(request_body), index=self.annotation_indexer_config.sink_indexer.get_index_name())
+          self.annotation_indexer_config.sink_indexer.put_mapping(request_body, create_index=True)
 
         continue_read = True
- 
-        seg_batch_date_start = batch_date_start
+
+        # the window bounds are kept as datetimes and only formatted for the queries
+        python_date_format = self.annotation_indexer_config.python_date_format
+        dt_seg_batch_date_end = datetime.strptime(batch_date_start, python_date_format)
+        dt_batch_date_end = datetime.strptime(batch_date_end, python_date_format)
         seg_batch_date_end = batch_date_start
+
+        # tune the indices receiving the annotations for the time of the bulk ingestion,
+        # the source index settings (replicas, translog) are never changed when ingesting into the same index
+        bulk_mode = contextlib.nullcontext() if self.annotation_indexer_config.same_index_ingest \
+            else self.annotation_indexer_config.sink_indexer.bulk_mode()
+
+        interval = self.annotation_indexer_config.interval
+
+        with bulk_mode:
+            while continue_read:
+                seg_batch_date_start = seg_batch_date_end
+                dt_seg_batch_date_end += timedelta(days=interval)
+
+                if dt_seg_batch_date_end >= dt_batch_date_end:
+                    seg_batch_date_end = batch_date_end
+                    continue_read = False
+                else:
+                    seg_batch_date_end = dt_seg_batch_date_end.strftime(python_date_format)
  
-        while continue_read:
-            seg_batch_date_start = seg_batch_date_end
-            dt_seg_batch_date_end = datetime.strptime(seg_batch_date_start, self.annotation_indexer_config.python_date_format) + timedelta(days=self.annotation_indexer_config.interval)
-            seg_batch_date_end = dt_seg_batch_date_end.strftime(self.annotation_indexer_config.python_date_format)
- 
-            if dt_seg_batch_date_end >= datetime.strptime(batch_date_end, self.annotation_indexer_config.python_date_format):
-                seg_batch_date_end = batch_date_end
-                continue_read = False
- 
-            self.log.info('Fetching document ids that match the criteria... ' + seg_batch_date_start + ' - ' + seg_batch_date_end)
-            doc_ids = self._get_doc_ids_range(seg_batch_date_start, seg_batch_date_end)
-          
-            self.log.info('Found documents: %d' % len(doc_ids))
-            with ThreadPoolExecutor(max_workers=self.annotation_indexer_config.threads) as executor:
-                executor.map(self._process_document, doc_ids)
+                self.log.info('Fetching documents that match the criteria... ' + seg_batch_date_start + ' - ' + seg_batch_date_end)
+                docs = self._get_docs_range(seg_batch_date_start, seg_batch_date_end)
+                total_docs = self._process_documents(docs)
+
+                self.log.info('Found documents: %d' % total_docs)
+                if self.annotation_indexer_config.nlp_cache_size > 0:
+                    self.log.info('NLP cache hits: %d, misses: %d' % (self.nlp_cache_hits, self.nlp_cache_misses))
+
+                interval = self._adapt_interval(interval, total_docs)
@@ -2,10 +2,55 @@
 
 import elasticsearch
 import elasticsearch.helpers
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+import orjson
 import logging
-import socket
-from ssl import Purpose, create_default_context
+from ssl import create_default_context
 import os
+import hashlib
+import queue
+import threading
+import warnings
+from contextlib import contextmanager
+from functools import lru_cache
+
+from ingester.utils import chunked
+
+# process-wide cache of ElasticSearch clients, keyed by the connection details,
+# so that connectors to the same cluster share the underlying connection pool
+_CLIENT_CACHE = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+# process-wide record of the mappings already put to the indices, keyed by the client, index name and mapping digest
+_PUSHED_MAPPINGS = set()
+_PUSHED_MAPPINGS_LOCK = threading.Lock()
+
+################################
+#
+# serializer
+#
+class ORJSONSerializer(JSONSerializer):
+    """
+    JSON serializer for the ElasticSearch client backed by orjson
+    Falls back to the client's default conversions for the types orjson does not support natively
+    """
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+
+        try:
+            return orjson.dumps(data, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
 
 ################################
 #
@@ -33,14 +78,16 @@ class ElasticConnectorConfig:
     ElasticSearch connector configuration
     All the hosts details are specified using RFC-1738
     """
-    def __init__(self, hosts, credentials=None, extra_params=None, ssl_config=None):
+    def __init__(self, hosts, credentials=None, extra_params=None, ssl_config=None, thread_count=1):
         """
         :param hosts: the ElasticSearch hosts specified in RFC-1738 format
+        :param thread_count: the number of threads expected to use the connection concurrently
         """
         self.hosts = hosts
         self.credentials = credentials
         self.ssl_config = ssl_config
         self.extra_params= extra_params
+        self.thread_count = thread_count
 
 ################################
 #
@@ -51,15 +98,21 @@ class ElasticConnector:
     ElasticSearch connector
     At the moment supports only single-node clusters
     """
+
+    # the minimum size of the per-host connection pool, the default urllib3 pool holds only 10 connections
+    MIN_CONNECTION_POOL_SIZE = 25
+    REQUEST_TIMEOUT_S = 60
+    MAX_RETRIES = 3
+
     def __init__(self, elastic_conf):
         """
         :param elastic_conf: ElasticSearch configuration :class:`~ElasticConnectorConfig`
         """
-        # check whether we can actually connect to ElasticSearch
         try:
             args = {
                 "verify_certs" : elastic_conf.extra_params['verify-certs'],
-                "use_ssl" : elastic_conf.extra_params['use-ssl']
+                "use_ssl" : elastic_conf.extra_params['use-ssl'],
+                "maxsize" : max(elastic_conf.thread_count * 2, self.MIN_CONNECTION_POOL_SIZE)
             }
 
             if elastic_conf.ssl_config is not None:
@@ -71,19 +124,87 @@ class ElasticConnector:
                 args["client_cert"] = elastic_conf.ssl_config.client_cert_path
                 args["client_key"] = elastic_conf.ssl_config.client_key_path
           
-            if elastic_conf.credentials["use-api-key"]:
-                args["api_key"] = (elastic_conf.credentials["username"], elastic_conf.credentials["password"])
-            else:
-                args["http_auth"] = (elastic_conf.credentials["username"], elastic_conf.credentials["password"])
-
-            self.es = elasticsearch.Elasticsearch(hosts=elastic_conf.hosts, retry_on_timeout=True,  **args)
-
-            if self.es.ping() is not True:
-                raise Exception("Cannot connect to ElasticSearch: %s" % str(elastic_conf.hosts))
+            # authenticate only when the credentials are provided, passing them in the client-native tuple form
+            credentials = elastic_conf.credentials or {}
+            if credentials.get("username"):
+                auth = (credentials["username"], credentials.get("password"))
+                if credentials.get("use-api-key"):
+                    args["api_key"] = auth
+                else:
+                    args["http_auth"] = auth
+
+            client_key = self._get_client_key(elastic_conf, args)
+
+            with _CLIENT_CACHE_LOCK:
+                self.es = _CLIENT_CACHE.get(client_key)
+
+                if self.es is None:
+                    self.es = elasticsearch.Elasticsearch(hosts=elastic_conf.hosts, retry_on_timeout=True,
+                                                          http_compress=True, sniff_on_start=False,
+                                                          timeout=self.REQUEST_TIMEOUT_S,
+                                                          max_retries=self.MAX_RETRIES,
+                                                          serializer=ORJSONSerializer(),
+                                                          **args)
+                    _CLIENT_CACHE[client_key] = self.es
         except Exception as e:           
             logging.error(repr(e))
             raise Exception(str(e))
 
+    @classmethod
+    def check_health(cls):
+        """
+        Checks whether all the ElasticSearch clusters used by the created connectors are available,
+        issuing a single health request per distinct client
+        """
+        with _CLIENT_CACHE_LOCK:
+            clients = list(_CLIENT_CACHE.values())
+
+        for es in clients:
+            try:
+                health = es.cluster.health(wait_for_status='yellow', timeout='5s')
+            except Exception as e:
+                logging.error(repr(e))
+                raise Exception("Cannot connect to ElasticSearch: %s" % str(e))
+
+            if health.get('timed_out'):
+                raise Exception("ElasticSearch cluster is not available, status: %s" % health.get('status'))
+
+    @staticmethod
+    def _get_client_key(elastic_conf, args):
+        """
+        Builds a hashable key identifying the client connection details
+        :param elastic_conf: ElasticSearch configuration :class:`~ElasticConnectorConfig`
+        :param args: the client connection arguments
+        :return: the key used in the clients cache
+        """
+        hosts = elastic_conf.hosts
+        hosts_key = tuple(hosts) if isinstance(hosts, (list, tuple)) else (hosts,)
+
+        # the SSL context is not hashable, the CA file it has been created from identifies it instead
+        args_key = tuple(sorted((k, v) for k, v in args.items() if k != "ssl_context"))
+        ssl_context_key = elastic_conf.ssl_config.ca_file_path if "ssl_context" in args else None
+
+        return hosts_key, args_key, ssl_context_key
+
+
+# translation table replacing the characters not allowed in ElasticSearch index names
+_INDEX_NAME_TRANSLATION = str.maketrans({c: '_' for c in '#\\/*?"<>|, '})
+
+
+@lru_cache(maxsize=4096)
+def _format_index_name(index_name):
+    """
+    ElasticSearch index name must follow certain rules:
+    - must not contain the characters #, \\, /, *, ?, ", <, >, |, ,
+    - must not start with _, - or +
+    - must not be . or ..
+    - must be lowercase
+    The formatted names are cached, as the same names are resolved for every indexed document
+    :param index_name: a possible index name
+    :return: correct index name
+    """
+    return index_name.lower().strip('._-+').translate(_INDEX_NAME_TRANSLATION)
+
 
 ################################
 #
@@ -94,41 +215,71 @@ class ElasticIndexer:
     ElasticSearch indexer
     """
 
-    # the size of chunk when indexing documents in bulk
-    BULK_CHUNK_SIZE = 10000
-    BULK_REQUEST_TIMEOUT_S = 30
+    # the timeout of a single bulk request, the requests of up to the maximum chunk size are compressed
+    # and may take a while to be decompressed and indexed by a loaded cluster
+    BULK_REQUEST_TIMEOUT_S = 120
+
+    # the timeout of the force merge following the bulk indexing, merging a large index takes a long time
+    FORCE_MERGE_TIMEOUT_S = 3600
+
+    # the maximum number of indices reported when counting documents per index
+    MAX_AGGREGATED_INDICES = 10000
+
+    # the number of documents retrieved in a single multi-get request
+    MGET_CHUNK_SIZE = 1000
+
+    # the number of ids checked in a single request when looking up existing documents
+    EXISTS_QUERY_CHUNK_SIZE = 1024
 
-    def __init__(self, es_connector, index_name):
+    # scroll keep-alive and page size used when scanning through the documents
+    SCAN_SCROLL_TIMEOUT = '10m'
+    SCAN_PAGE_SIZE = 1000
+
+    def __init__(self, es_connector, index_name, thread_count=4, chunk_size=1000,
+                 max_chunk_bytes=15 * 1024 * 1024, queue_size=4, bulk_settings=None, steady_settings=None,
+                 force_merge_segments=None, scan_slices=1):
         """
         :param es_connector: ElasticSearch connector :class:`~ElasticConnector`
         :param index_name: the name of the index
+        :param thread_count: the number of threads used when indexing documents in parallel bulk
+        :param chunk_size: the maximum number of documents sent in a single bulk request
+        :param max_chunk_bytes: the maximum size of a single bulk request (in bytes), a chunk is flushed
+                                whenever either of the limits is reached, keeping it well under
+                                the ElasticSearch `http.max_content_length` regardless of the documents size
+        :param queue_size: the size of the task queue between the main thread and the bulk threads
+        :param bulk_settings: optional, the index settings applied for the time of bulk indexing,
+                              the index is not tuned for bulk indexing when not provided
+        :param steady_settings: optional, the index settings applied after bulk indexing,
+                                the settings preceding the bulk indexing are restored by default
+        :param force_merge_segments: optional, the number of segments the index is force-merged to
+                                     after bulk indexing, the index is not merged when not provided
+        :param scan_slices: the number of slices scanned in parallel when scanning through the documents,
+                            ideally the number of shards of the index
         """
         self.conn = es_connector
         self.index_name = index_name
 
-        # deprecated in 6.x so use it as a build-in param here
-        self.doc_type = 'doc'
+        # wildcard pattern matching all the suffixed indices, used as-is by search requests
+        self.search_all_index_name = "%s-*" % self.index_name
 
-        self.index_name_cache = {}
+        self.thread_count = thread_count
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.queue_size = queue_size
 
-        self.log = logging.getLogger('ElasticIndexer')
+        self.bulk_settings = bulk_settings or {}
+        self.steady_settings = steady_settings
+        self.force_merge_segments = force_merge_segments
+        # the indices tuned for the bulk indexing while in the bulk mode, in the order of tuning
+        self.bulk_mode_active = False
+        self.bulk_tuned_indices = []
+        self.bulk_tuned_lock = threading.Lock()
+        # the settings replaced by the bulk settings, per index
+        self.replaced_settings = {}
 
-    def _format_index_name(self, index_name):
-        """
-        ElasticSearch index name must follow certain rules:
-        - must not contain the characters #, \, /, *, ?, ", <, >, |, ,
-        - must not start with _, - or +
-        - must not be . or ..
-        - must be lowercase
-        :param index_name: a possible index name
-        :return: correct index name
-        """
-        return index_name.lower()\
-            .strip('.').strip('_').strip('-').strip('+')\
-            .replace('#', '_').replace('\\', '_').replace('\/', '_')\
-            .replace('*', '_').replace('?', '_').replace('"', '_')\
-            .replace('<', '_').replace('>', '_').replace('|', '_')\
-            .replace(' ', '_')
+        self.scan_slices = scan_slices
+
+        self.log = logging.getLogger('ElasticIndexer')
 
     def get_index_name(self, suffix="", search_only=False):
         """
@@ -139,16 +290,13 @@ class ElasticIndexer:
         """
         if len(suffix) > 0:
             if search_only and suffix == "*":
-                return "%s-*" % self.index_name
+                return self.search_all_index_name
 
             index_name = "%s-%s" % (self.index_name, suffix)
         else:
             index_name = self.index_name
 
-        if index_name not in self.index_name_cache:
-            self.index_name_cache[index_name] = self._format_index_name(index_name)
-
-        return self.index_name_cache[index_name]
+        return _format_index_name(index_name)
 
     def get_doc_count(self, index_suffix=""):
         """
@@ -156,7 +304,32 @@ class ElasticIndexer:
         :param index_suffix: an optional suffix of the index to query
         :return: the number of records
         """
-        res = self.conn.es.count(self.get_index_name(suffix=index_suffix, search_only=True))
+        res = self.conn.es.count(index=self.get_index_name(suffix=index_suffix, search_only=True))
+        return int(res['count'])
+
+    def get_doc_counts(self, index_suffixes, per_index=False):
+        """
+        Queries the indices with the given suffixes for the number of documents in a single request
+        :param index_suffixes: the suffixes of the indices to query
+        :param per_index: whether to return the number of documents for each index separately
+        :return: the total number of records, or the number of records per index name if `per_index` is set
+        """
+        index_names = ",".join(self.get_index_name(suffix=suffix, search_only=True) for suffix in index_suffixes)
+
+        if per_index:
+            # aggregating on the index name counts the top-level documents only, unlike `_cat/indices`
+            query_body = {
+                "size": 0,
+                "aggs": {
+                    "indices": {
+                        "terms": {"field": "_index", "size": self.MAX_AGGREGATED_INDICES}
+                    }
+                }
+            }
+            res = self.conn.es.search(index=index_names, body=query_body)
+            return {bucket['key']: int(bucket['doc_count']) for bucket in res['aggregations']['indices']['buckets']}
+
+        res = self.conn.es.count(index=index_names)
         return int(res['count'])
 
     def drop_index(self, index_suffix=""):
@@ -166,6 +339,122 @@ class ElasticIndexer:
         """
         self.conn.es.indices.delete(index=self.get_index_name(index_suffix))
 
+    def put_mapping(self, mapping, index_suffix="", create_index=False):
+        """
+        Updates the mapping of the index, skipping the mappings already put to the index by this process,
+        as each mapping update is a cluster state update
+        :param mapping: the mapping to put, represented as KVPs dictionary
+        :param index_suffix: optional suffix of the index to update
+        :param create_index: whether to create the index with the mapping if it does not exist yet
+        """
+        index_name = self.get_index_name(index_suffix)
+        mapping_digest = hashlib.blake2b(orjson.dumps(mapping, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+        mapping_key = (id(self.conn.es), index_name, mapping_digest)
+
+        with _PUSHED_MAPPINGS_LOCK:
+            if mapping_key in _PUSHED_MAPPINGS:
+                return
+
+        # a single request creates the missing index along with its mapping, an existing index is reported as a bad request
+        res = None
+        if create_index:
+            res = self.conn.es.indices.create(index=index_name, body={"mappings": mapping}, ignore=400)
+
+        if res is None or not res.get('acknowledged'):
+            self.conn.es.indices.put_mapping(index=index_name, body=mapping)
+
+        with _PUSHED_MAPPINGS_LOCK:
+            _PUSHED_MAPPINGS.add(mapping_key)
+
+    def set_bulk_indexing_mode(self, enabled, index_suffix="", index_name=None):
+        """
+        Switches the index between the bulk indexing and the steady state settings
+        :param enabled: True to apply the bulk settings, False to apply the steady state settings
+                        or, when not provided, to restore the settings replaced by the bulk settings
+        :param index_suffix: optional suffix of the index to tune
+        :param index_name: optional, the full name of the index to tune, overrides the suffix
+        """
+        if index_name is None:
+            index_name = self.get_index_name(index_suffix)
+
+        if enabled:
+            if not self.conn.es.indices.exists(index=index_name):
+                self.conn.es.indices.create(index=index_name)
+
+            settings = self.conn.es.indices.get_settings(index=index_name, flat_settings=True)[index_name]["settings"]
+            # settings not explicitly set on the index are restored to their defaults using null values
+            self.replaced_settings[index_name] = {key: settings.get("index." + key) for key in self.bulk_settings}
+
+            self.log.info("Tuning index settings for bulk indexing: " + index_name)
+            self.conn.es.indices.put_settings(index=index_name, body={"index": self.bulk_settings})
+            return
+
+        replaced_settings = self.replaced_settings.pop(index_name, None)
+        settings = self.steady_settings if self.steady_settings is not None else replaced_settings
+        if settings:
+            self.log.info("Restoring index settings: " + index_name)
+            self.conn.es.indices.put_settings(index=index_name, body={"index": settings})
+
+    @contextmanager
+    def bulk_mode(self):
+        """
+        Tunes the indices written to within the block for sustained bulk indexing with the bulk settings,
+        each index is tuned before its first bulk request; on exit the steady state settings are applied
+        and the indices are refreshed, then force-merged when configured
+        Nothing is changed when no bulk settings are configured
+        If the process is killed within the block, the bulk settings are left on the indices
+        """
+        if not self.bulk_settings:
+            yield
+            return
+
+        self.bulk_mode_active = True
+        try:
+            yield
+        finally:
+            self.bulk_mode_active = False
+            with self.bulk_tuned_lock:
+                tuned_indices, self.bulk_tuned_indices = self.bulk_tuned_indices, []
+
+            # each index is restored on its own, so that a failure does not leave the remaining ones tuned
+            restore_error = None
+            for index_name in tuned_indices:
+                try:
+                    self.set_bulk_indexing_mode(False, index_name=index_name)
+                except Exception as e:
+                    self.log.error("Cannot restore the settings of index: " + index_name + ": " + repr(e))
+                    restore_error = restore_error or e
+            if restore_error is not None:
+                raise restore_error
+
+        for index_name in tuned_indices:
+            # make the indexed documents visible without waiting for the restored refresh interval
+            self.conn.es.indices.refresh(index=index_name)
+            if self.force_merge_segments:
+                self.conn.es.indices.forcemerge(index=index_name, max_num_segments=self.force_merge_segments,
+                                                request_timeout=self.FORCE_MERGE_TIMEOUT_S)
+
+    def _tune_for_bulk(self, index_name):
+        """
+        Applies the bulk settings to the index the first time it is written to within the bulk mode
+        :param index_name: the full name of the index
+        """
+        if not self.bulk_mode_active or index_name in self.bulk_tuned_indices:
+            return
+
+        with self.bulk_tuned_lock:
+            if index_name not in self.bulk_tuned_indices:
+                self.set_bulk_indexing_mode(True, index_name=index_name)
+                self.bulk_tuned_indices.append(index_name)
+
+    def _tuned_actions(self, actions):
+        """
+        Passes the bulk actions through, tuning the indices they are sent to for the bulk indexing
+        """
+        for action in actions:
+            self._tune_for_bulk(action.get('_index', self.index_name))
+            yield action
+
     def index_doc(self, doc, doc_id=None, index_suffix=""):
         """
         Indexes the given document under under specified id
@@ -178,78 +467,136 @@ class ElasticIndexer:
         except Exception as e:
             self.log.error("Exception caught while indexing document: " + str(e))
 
+    def _count_bulk_results(self, results):
+        """
+        Consumes the results of the parallel bulk indexing, which drives the bulk threads, and logs the number
+        of the failed documents; the documents rejected by `create` actions as already present are not failures
+        :param results: the generator of (status, result) pairs returned by the parallel bulk helper
+        """
+        failed_docs = 0
+        existing_docs = 0
+        for status, result in results:
+            if status is False:
+                if result.get('create', {}).get('status') == 409:
+                    existing_docs += 1
+                else:
+                    failed_docs += 1
+
+        if existing_docs:
+            self.log.info("Skipped already indexed documents in bulk: %d " % existing_docs)
+        if failed_docs:
+            self.log.warning("Failed indexing documents in bulk: %d " % failed_docs)
+
     def index_docs_bulk(self, docs, index_suffix=""):
         """
-        Indexes the documents using ElasticSearch bulk API
-        :param docs: the array of documents, each represented as KVPs
+        Indexes the documents using ElasticSearch parallel bulk API
+        :param docs: the iterable (preferably a generator) of documents, each represented as KVPs
         :param index_suffix: an optional index suffix name
         """
         index_name = self.get_index_name(index_suffix)
         try:
-            elasticsearch.helpers.bulk(self.conn.es, docs, index=index_name)
+            self._tune_for_bulk(index_name)
+            self._count_bulk_results(elasticsearch.helpers.parallel_bulk(self.conn.es, docs,
+                                                                         index=index_name,
+                                                                         thread_count=self.thread_count,
+                                                                         chunk_size=self.chunk_size,
+                                                                         max_chunk_bytes=self.max_chunk_bytes,
+                                                                         queue_size=self.queue_size,
+                                                                         raise_on_error=False,
+                                                                         raise_on_exception=False,
+                                                                         request_timeout=self.BULK_REQUEST_TIMEOUT_S))
         except Exception as e:
             self.log.error("Exception caught while indexing documents in bulk: " + str(e))
 
-    def index_docs_bulk_gen(self, actions_generator):
+    def index_docs_bulk_gen(self, actions_generator, thread_count=None, chunk_size=None, max_chunk_bytes=None, queue_size=None):
         """
-        Indexes the documents using ElasticSearch bulk API
+        Indexes the documents using ElasticSearch parallel bulk API
         :param actions_generator: the generator of documents, must include the index name
+        :param thread_count: optional, the number of bulk threads, the indexer setting is used if not provided
+        :param chunk_size: optional, the number of documents per bulk request, the indexer setting is used if not provided
+        :param max_chunk_bytes: optional, the maximum bulk request size, the indexer setting is used if not provided
+        :param queue_size: optional, the bulk threads queue size, the indexer setting is used if not provided
+        The failed requests are counted as failed documents instead of interrupting the indexing of the remaining ones
         """
-        failed_docs = 0
         try:
-            for status, result in elasticsearch.helpers.streaming_bulk(self.conn.es,
-                                                                       actions=actions_generator,
-                                                                       chunk_size=self.BULK_CHUNK_SIZE,
-                                                                       request_timeout=self.BULK_REQUEST_TIMEOUT_S):
-                if status is False:
-                    failed_docs += 1
-            if failed_docs:
-                self.log.warn("Failed indexing documents in bulk: %d " % failed_docs)
-
+            if self.bulk_mode_active:
+                actions_generator = self._tuned_actions(actions_generator)
+
+            self._count_bulk_results(elasticsearch.helpers.parallel_bulk(self.conn.es,
+                                                                         actions=actions_generator,
+                                                                         thread_count=thread_count or self.thread_count,
+                                                                         chunk_size=chunk_size or self.chunk_size,
+                                                                         max_chunk_bytes=max_chunk_bytes or self.max_chunk_bytes,
+                                                                         queue_size=queue_size or self.queue_size,
+                                                                         raise_on_error=False,
+                                                                         raise_on_exception=False,
+                                                                         request_timeout=self.BULK_REQUEST_TIMEOUT_S))
         except Exception as e:
             self.log.error("Exception caught while indexing documents in bulk: " + str(e))
 
-    def get_doc(self, doc_id, index_suffix=""):
+    def get_doc(self, doc_id, index_suffix="", ignore_missing=False):
         """
         Retrieves the given document from a given index with a specified id
         :param doc_id: the id of the document
         :param index_suffix: optional suffix of the index to store the document
+        :param ignore_missing: whether to return None for a missing document instead of raising an exception
         :return: the document represented as KVPs dictionary
         """
-        res = self.conn.es.get(index=self.get_index_name(index_suffix), id=doc_id)
+        if ignore_missing:
+            res = self.conn.es.get(index=self.get_index_name(index_suffix), id=doc_id, ignore=404)
+            if not res.get('found'):
+                return None
+        else:
+            res = self.conn.es.get(index=self.get_index_name(index_suffix), id=doc_id)
 
         assert '_source' in res
 
         result = res["_source"]
-        if "_id" in res.keys():
+        if "_id" in res:
             result.update({"_id": res["_id"]})
-        if "_type" in res.keys():
+        if "_type" in res:
             result.update({"_type": res["_type"]})
-        if "_index" in res.keys():
+        if "_index" in res:
             result.update({"_index": res["_index"]})
 
         return result
 
+    def get_docs(self, doc_ids, index_suffix="", fields=None):
+        """
+        Retrieves the documents with the specified ids using ElasticSearch multi-get API
+        :param doc_ids: the ids of the documents
+        :param index_suffix: optional suffix of the index to store the document
+        :param fields: optional, the source fields to retrieve, all the fields are retrieved if not provided
+        :return: the found documents represented as KVPs dictionaries, missing documents are omitted
+        """
+        docs = []
+        for ids_chunk in chunked(doc_ids, self.MGET_CHUNK_SIZE):
+            if fields is not None:
+                res = self.conn.es.mget(index=self.get_index_name(index_suffix), body={"ids": ids_chunk}, _source_includes=list(fields))
+            else:
+                res = self.conn.es.mget(index=self.get_index_name(index_suffix), body={"ids": ids_chunk})
+
+            for doc in res['docs']:
+                if not doc.get('found'):
+                    continue
+
+                result = doc["_source"]
+                result.update({"_id": doc["_id"], "_index": doc["_index"]})
+                if "_type" in doc:
+                    result.update({"_type": doc["_type"]})
+                docs.append(result)
+
+        return docs
+
     def get_doc_ids(self, index_suffix=""):
         """
         Retrieves the ids of all the documents
+        Deprecated: a plain search returns only the first page of hits, use :meth:`get_doc_ids_scan` instead
         :param index_suffix: optional suffix of the index to store the document
         :return: the document ids in array
         """
-        query_body = {
-            "query": {
-                "match_all": {}
-            },
-            "stored_fields": []
-        }
-
-        meta = self.conn.es.search(index=self.get_index_name(suffix=index_suffix, search_only=True),
-                                   body=query_body)
-        if 'hits' not in meta:
-            return []
-
-        ids = [hit['_id'] for hit in meta['hits']['hits']]
-        return ids
+        warnings.warn("get_doc_ids is deprecated, use get_doc_ids_scan instead", DeprecationWarning, stacklevel=2)
+        return self.get_doc_ids_scan(index_suffix)
 
     def doc_exists(self, match_criteria, index_suffix=""):
         """
@@ -270,26 +617,133 @@ class ElasticIndexer:
         res = self.conn.es.count(index=index_name, body=query_body)
         return int(res['count']) > 0
 
-    def get_doc_ids_scan(self, index_suffix=""):
-        """
-        Retrieves the ids of all the documents using ElasticSearch scan API
+    def _scan(self, query_body, index_name):
+        """
+        Scans through the documents matching the query using ElasticSearch scan API, reading the slices
+        of the scroll in parallel threads when more than one slice is configured
+        :param query_body: the search query
+        :param index_name: the name of the index to scan
+        :return: the generator of the hits, in no particular order
+        """
+        if self.scan_slices <= 1:
+            yield from elasticsearch.helpers.scan(self.conn.es,
+                                                  query=query_body,
+                                                  index=index_name,
+                                                  scroll=self.SCAN_SCROLL_TIMEOUT,
+                                                  size=self.SCAN_PAGE_SIZE,
+                                                  preserve_order=False)
+            return
+
+        hits_queue = queue.Queue(maxsize=self.SCAN_PAGE_SIZE * self.scan_slices)
+        stopped = threading.Event()
+        finished = object()
+
+        def put(item):
+            # give up when the consumer has stopped reading, instead of blocking on the full queue
+            while not stopped.is_set():
+                try:
+                    hits_queue.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def scan_slice(slice_id):
+            try:
+                slice_query = dict(query_body, slice={"id": slice_id, "max": self.scan_slices})
+                for hit in elasticsearch.helpers.scan(self.conn.es,
+                                                      query=slice_query,
+                                                      index=index_name,
+                                                      scroll=self.SCAN_SCROLL_TIMEOUT,
+                                                      size=self.SCAN_PAGE_SIZE,
+                                                      preserve_order=False):
+                    if not put(hit):
+                        return
+                put(finished)
+            except Exception as e:
+                put(e)
+
+        threads = [threading.Thread(target=scan_slice, args=(slice_id,), daemon=True) for slice_id in range(self.scan_slices)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            running_slices = len(threads)
+            while running_slices > 0:
+                item = hits_queue.get()
+                if item is finished:
+                    running_slices -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stopped.set()
+
+    def iter_doc_ids_scan(self, index_suffix=""):
+        """
+        Streams the ids of all the documents using ElasticSearch scan API
         :param index_suffix: optional suffix of the index to store the document
-        :return: the document ids in array
+        :return: the generator of document ids
         """
         query_body = {
             "query": {
                 "match_all": {}
             },
+            "_source": False,
             "stored_fields": []
         }
 
-        ids_generator = elasticsearch.helpers.scan(self.conn.es,
-                                                   query=query_body,
-                                                   index=self.get_index_name(suffix=index_suffix,
-                                                                             search_only=True))
-        ids = [hit['_id'] for hit in ids_generator]
-        
-        return ids
+        ids_generator = self._scan(query_body, self.get_index_name(suffix=index_suffix, search_only=True))
+        for hit in ids_generator:
+            yield hit['_id']
+
+    def existing_ids(self, ids, id_field="_id", index_suffix=""):
+        """
+        Checks in bulk which of the ids are already present in the index
+        :param ids: the ids to check
+        :param id_field: the field containing the id, the document `_id` by default
+        :param index_suffix: optional suffix of the index to store the document
+        :return: the set of ids that are present in the index
+        """
+        index_name = self.get_index_name(suffix=index_suffix, search_only=True)
+        if not self.conn.es.indices.exists(index=index_name):
+            return set()
+
+        existing = set()
+        for ids_chunk in chunked(ids, self.EXISTS_QUERY_CHUNK_SIZE):
+            if id_field == "_id":
+                query_body = {
+                    "query": {
+                        "terms": {"_id": ids_chunk}
+                    },
+                    "_source": False,
+                    "size": len(ids_chunk)
+                }
+                res = self.conn.es.search(index=index_name, body=query_body)
+                existing.update(hit['_id'] for hit in res['hits']['hits'])
+            else:
+                # the field may hold analyzed text, hence use the same match criteria as `doc_exists`,
+                # but send all the queries of the chunk in a single multi-search request
+                searches = []
+                for doc_id in ids_chunk:
+                    searches.append({})
+                    searches.append({"query": {"match": {id_field: doc_id}}, "size": 0, "terminate_after": 1})
+
+                res = self.conn.es.msearch(index=index_name, body=searches)
+                for doc_id, response in zip(ids_chunk, res['responses']):
+                    if 'hits' in response and response['hits']['total']['value'] > 0:
+                        existing.add(doc_id)
+
+        return existing
+
+    def get_doc_ids_scan(self, index_suffix=""):
+        """
+        Retrieves the ids of all the documents using ElasticSearch scan API
+        :param index_suffix: optional suffix of the index to store the document
+        :return: the document ids in array
+        """
+        return list(self.iter_doc_ids_scan(index_suffix=index_suffix))
 
 
 ################################
@@ -297,34 +751,83 @@ class ElasticIndexer:
 # ranged indexer
 #
 class ElasticRangedIndexer(ElasticIndexer):
-    def __init__(self, es_connector, index_name):
-        super().__init__(es_connector, index_name)
+    def __init__(self, es_connector, index_name, **kwargs):
+        super().__init__(es_connector, index_name, **kwargs)
 
-    def get_doc_ids_by_range_scan(self, date_field, date_begin, date_end, date_format="yyyy-MM-dd", index_suffix=""):
+    @staticmethod
+    def _range_query(date_field, date_begin, date_end, date_format):
         """
-        Retrieves the ids of all the documents using ElasticSearch scan API
+        Creates the body of the query for the documents within the date range, as a filter so that
+        it is not scored and its result can be cached by ElasticSearch
         :param date_field: the name of the field containing the date
         :param date_begin: begin of the range, inclusive
-        :param date_end: optional suffix of the index to store the document
+        :param date_end: end of the range, inclusive
         :param date_format: the format of the date field
-        :param index_suffix: end of the range, inclusive
-        :return: the document ids in array
+        :return: the query body
         """
-        query_body = {
+        return {
             "query": {
-                "range": {
-                    date_field: {
-                        "gte": date_begin,
-                        "lte": date_end,
-                        "format": date_format
+                "bool": {
+                    "filter": {
+                        "range": {
+                            date_field: {
+                                "gte": date_begin,
+                                "lte": date_end,
+                                "format": date_format
+                            }
+                        }
                     }
                 }
-            },
-            "stored_fields": []
+            }
         }
 
-        ids_generator = elasticsearch.helpers.scan(self.conn.es,
-                                                   query=query_body,
-                                                   index=self.get_index_name(index_suffix))
-        ids = [hit['_id'] for hit in ids_generator]
-        return ids
+    def iter_doc_ids_by_range_scan(self, date_field, date_begin, date_end, date_format="yyyy-MM-dd", index_suffix=""):
+        """
+        Streams the ids of the documents within the date range using ElasticSearch scan API
+        :param date_field: the name of the field containing the date
+        :param date_begin: begin of the range, inclusive
+        :param date_end: end of the range, inclusive
+        :param date_format: the format of the date field
+        :param index_suffix: optional suffix of the index to store the document
+        :return: the generator of document ids
+        """
+        query_body = self._range_query(date_field, date_begin, date_end, date_format)
+        query_body.update({"_source": False, "stored_fields": []})
+
+        ids_generator = self._scan(query_body, self.get_index_name(index_suffix))
+        for hit in ids_generator:
+            yield hit['_id']
+
+    def iter_docs_by_range_scan(self, date_field, date_begin, date_end, fields=None, date_format="yyyy-MM-dd", index_suffix=""):
+        """
+        Streams the documents within the date range using ElasticSearch scan API
+        :param date_field: the name of the field containing the date
+        :param date_begin: begin of the range, inclusive
+        :param date_end: end of the range, inclusive
+        :param fields: optional, the source fields to retrieve, all the fields are returned if not specified
+        :param date_format: the format of the date field
+        :param index_suffix: optional suffix of the index to store the document
+        :return: the generator of documents represented as KVPs dictionaries
+        """
+        query_body = self._range_query(date_field, date_begin, date_end, date_format)
+        if fields:
+            query_body["_source"] = list(fields)
+
+        docs_generator = self._scan(query_body, self.get_index_name(index_suffix))
+        for hit in docs_generator:
+            result = hit.get("_source", {})
+            result.update({"_id": hit["_id"], "_index": hit["_index"]})
+            yield result
+
+    def get_doc_ids_by_range_scan(self, date_field, date_begin, date_end, date_format="yyyy-MM-dd", index_suffix=""):
+        """
+        Retrieves the ids of all the documents within the date range using ElasticSearch scan API
+        :param date_field: the name of the field containing the date
+        :param date_begin: begin of the range, inclusive
+        :param date_end: end of the range, inclusive
+        :param date_format: the format of the date field
+        :param index_suffix: optional suffix of the index to store the document
+        :return: the document ids in array
+        """
+        return list(self.iter_doc_ids_by_range_scan(date_field, date_begin, date_end,
+                                                    date_format=date_format, index_suffix=index_suffix))
@@ -1,11 +1,26 @@
 #!/usr/bin/python
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from ingester.utils import check_url_available
+import gzip
 import logging
-import json
+import orjson
+import random
 import requests
-import traceback
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class JitteredRetry(Retry):
+    """
+    The retry policy adding a random jitter to the exponential backoff, so that the threads
+    failing together do not retry together against an overloaded NLP service
+    """
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, self.backoff_factor) if backoff > 0 else backoff
+
 
 ################################
 #
@@ -15,29 +30,166 @@ class NlpService:
     """
     The NLP service for querying the NLP REST API
     """
-    def __init__(self, url_endpoint, endpoint_request_mode, use_bulk_indexing, username, password, max_number_of_retries=1):
+
+    # the statuses of the transient failures for which the requests are retried
+    RETRY_STATUSES = [429, 500, 502, 503, 504]
+    RETRY_BACKOFF_FACTOR = 0.5
+
+    # the time to establish the connection
+    CONNECT_TIMEOUT_S = 10
+
+    # the headers of the requests sending the documents as JSON and as plain text (in `gate-nlp` mode)
+    JSON_HEADERS = {"Access-Control-Allow-Origin" : "*", "Content-Type": "application/json"}
+    TEXT_HEADERS = {"Access-Control-Allow-Origin" : "*", "Content-Type": "text/plain"}
+
+    # the JSON request bodies are compressed only above this size, the smaller ones would not get any shorter
+    COMPRESS_MIN_BYTES = 1024
+    COMPRESS_LEVEL = 1
+
+    def __init__(self, url_endpoint, endpoint_request_mode, use_bulk_indexing, username, password, max_number_of_retries=1,
+                 bulk_url_endpoint=None, pool_size=10, compress_requests=False, read_timeout=600):
         """
         :param url_endpoint: the full url endpoint to query
+        :param bulk_url_endpoint: optional, the full url endpoint processing multiple documents in a single request
+                                  (e.g. MedCAT `/api/process_bulk`), one per each `url_endpoint`
+        :param pool_size: optional, the number of connections kept open per NLP service host,
+                          should match the number of threads querying the service
+        :param compress_requests: optional, whether to send the JSON request bodies compressed with gzip,
+                                  the NLP service must accept the `Content-Encoding: gzip` requests
+        :param read_timeout: optional, the time (in seconds) to wait for the NLP service response, generous enough
+                             for the processing of the longest documents or batches, the timed out requests are retried
         """
         self.log = logging.getLogger(self.__class__.__name__)
 
         self.endpoint_request_mode = endpoint_request_mode
+        self.is_gate_nlp = endpoint_request_mode == 'gate-nlp'
         self.url_endpoints = url_endpoint
+        self.bulk_url_endpoints = bulk_url_endpoint
         self.use_bulk_indexing = use_bulk_indexing
         self.username = username
         self.password = password
 
         self.max_number_of_retries = max_number_of_retries
+        self.compress_requests = compress_requests
+        self.timeout = (self.CONNECT_TIMEOUT_S, read_timeout)
+
+        # the session keeps the connections open across the requests, instead of connecting for each document
+        # and retries the failed requests with a growing delay
+        self.session = requests.Session()
+        retry = JitteredRetry(total=max_number_of_retries,
+                              backoff_factor=self.RETRY_BACKOFF_FACTOR,
+                              status_forcelist=self.RETRY_STATUSES,
+                              allowed_methods=["POST"],
+                              respect_retry_after_header=True,
+                              raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if self.username is not None:
+            self.session.auth = (self.username, self.password)
     
         if type(self.url_endpoints) is not list:
             self.url_endpoints = [self.url_endpoints]
-        
-        assert self.url_endpoints is not None and len(self.url_endpoints) > 0
+
+        if self.bulk_url_endpoints and type(self.bulk_url_endpoints) is not list:
+            self.bulk_url_endpoints = [self.bulk_url_endpoints]
 
         if self.url_endpoints is None or len(self.url_endpoints) == 0 or not check_url_available(self.url_endpoints):
             raise Exception("Cannot connect to the provided REST service endpoint")
 
-    def query(self, text, metadata={}, application_params={}):
+        # the pipelines are queried concurrently, so that a document waits for the slowest one instead of all of them in turn
+        self.endpoints_executor = None
+        endpoints_count = max(len(self.url_endpoints), len(self.bulk_url_endpoints or []))
+        if endpoints_count > 1:
+            self.endpoints_executor = ThreadPoolExecutor(max_workers=pool_size * endpoints_count,
+                                                         thread_name_prefix="nlp-endpoint")
+
+    def _post(self, url, query_body, headers):
+        """
+        Sends the request to the NLP service endpoint, the transient failures are retried by the session
+        :return: the decoded response, None if the request failed
+        """
+        if self.compress_requests and type(query_body) is bytes and len(query_body) >= self.COMPRESS_MIN_BYTES:
+            query_body = gzip.compress(query_body, compresslevel=self.COMPRESS_LEVEL)
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+
+        self.log.info("Requesting to " + url)
+        request = self.session.post(url, data=query_body, headers=headers,
+                                    timeout=self.timeout)
+
+        if request.status_code == 200:
+            return orjson.loads(request.content)
+
+        self.log.warning("document did not return the correct response, status code:"
+        + str(request.content)
+        + str(request.status_code) + "  " + request.reason + "\n The document will be reprocessed at the next check")
+        return None
+
+    def _post_all(self, urls, query_body, headers):
+        """
+        Sends the same request to all the NLP service endpoints
+        :return: the decoded responses, in the order of the endpoints
+        """
+        if self.endpoints_executor is None or len(urls) == 1:
+            return [self._post(url, query_body, headers) for url in urls]
+        return list(self.endpoints_executor.map(lambda url: self._post(url, query_body, headers), urls))
+
+    def _merge_responses(self, request_responses):
+        """
+        Merges the responses of the NLP service endpoints for a single document
+        :param request_responses: the responses of the endpoints
+        :return: the full NLP service response
+        """
+        final_response = {}
+        annotation_index = 0
+
+        current_timestamp = time.strftime("%H:%M:%S")
+
+        for response in request_responses:
+            if "result" in response:
+                if type(response["result"]) is not dict:
+                    response["result"] = orjson.loads(response["result"])
+
+                result = response["result"]
+                if "medcat_info" in response and "annotations" in result:
+                    # the fields added to all the entities are merged once per response
+                    entity_info = dict(response["medcat_info"], timestamp=result["timestamp"])
+                    for entity in result["annotations"]["entities"].values():
+                        entity.update(entity_info)
+                final_response = response
+
+            # Entities are present alone only when using GATE-NLP MODE ENDPOINT, they need formatting to match the MedCAT entities structure
+            if self.is_gate_nlp:
+                if "entities" in response and response["entities"] is not None:
+                    tmp_ents = response["entities"]
+                    formatted_result = {}
+                    text = response["text"]
+                    pipeline_url = response["pipeline_url"]
+                    for entity_type, entities in tmp_ents.items():
+                        entity_type = str(entity_type)
+                        for entity in entities:
+                            indices = entity["indices"]
+                            start, end = indices[0], indices[1]
+                            if type(start) is not int or type(end) is not int:
+                                start, end = int(start), int(end)
+
+                            entity.update({"type" : entity_type, "id" : annotation_index, "pipeline_url" : pipeline_url, "timestamp" : current_timestamp,
+                             "source_value" : text[start:end]})
+
+                            formatted_result[str(annotation_index)] = entity
+                            annotation_index += 1
+                    response["entities"] = formatted_result
+
+                for k, v in response.items():
+                    if k in final_response:
+                        if type(v) is dict:
+                            final_response[k].update(v)
+                    elif k != "pipeline_url":
+                        final_response[k] = v
+
+        return final_response
+
+    def query(self, text, metadata=None, application_params=None):
         """
         Sends the document to the NLP service to receive back the annotations
         :param text: the text to be processed
@@ -45,14 +197,23 @@ class NlpService:
         :param application_params: application parameters
         :return: returns the full NLP service response
         """
+        return self._query(text, metadata, application_params)[0]
+
+    def _query(self, text, metadata=None, application_params=None):
+        """
+        Sends the document to the NLP service to receive back the annotations
+        :return: the full NLP service response and whether all the endpoints returned their annotations,
+                 the response merged from the endpoints that did is returned on a partial failure
+        """
+        metadata = metadata or {}
+        application_params = application_params or {}
 
         try:
-            headers = {"Access-Control-Allow-Origin" : "*", "Content-Type": "application/json"}
-            auth = (self.username, self.password)
+            headers = self.JSON_HEADERS
             query_body = {}
 
             request_responses = []
-            final_response = {}
+            complete = True
 
             if len(self.endpoint_request_mode) == 0:
                 query_body = {
@@ -62,78 +223,91 @@ class NlpService:
                     "application_params": application_params,   
                     "footer": metadata
                 }
-                query_body = json.dumps(query_body)
+                query_body = orjson.dumps(query_body)
 
-            elif self.endpoint_request_mode == 'gate-nlp':
+            elif self.is_gate_nlp:
                 query_body = text
-                headers = {"Access-Control-Allow-Origin" : "*", "Content-Type": "text/plain"}
+                headers = self.TEXT_HEADERS
 
-            for url in self.url_endpoints:
-                self.log.info("Requesting to " + url)
-                request = requests.post(url, data=query_body, headers=headers, auth=auth)
+            for url, current_request in zip(self.url_endpoints, self._post_all(self.url_endpoints, query_body, headers)):
 
-                number_of_retries = 0
-
-                while(request.status_code != 200 and number_of_retries < self.max_number_of_retries):
-                    self.log.info("Request to " + url + " failed, retrying")
-                    request = requests.post(url, data=query_body, headers=headers, auth=auth)
-                    number_of_retries += 1
-
-                if request.status_code == 200:
-                    current_request = request.json()
-                    if self.endpoint_request_mode == 'gate-nlp' and current_request:
+                if current_request is not None:
+                    if self.is_gate_nlp and current_request:
                         current_request.update({"pipeline_url" : str(url)})
                     if current_request:
                         request_responses.append(current_request)
+                    else:
+                        complete = False
                 else:
-                    self.log.warning("document did not return the correct response, status code:"
-                    + str(request.content)
-                    + str(request.status_code) + "  " + request.reason + "\n The document will be reprocessed at the next check")
                     request_responses.append({})
+                    complete = False
 
+            return self._merge_responses(request_responses), complete
+        except Exception:
+            self.log.exception("Exception caught while querying the NLP service")
+            return None, False
 
+    def query_batch(self, texts, metadata=None, application_params=None):
+        """
+        Sends the documents to the NLP service in a single request per endpoint to receive back the annotations
+        The texts are queried one by one when no bulk endpoint is available
+        :param texts: the texts to be processed
+        :param metadata: metadata fields to be included with the response
+        :param application_params: application parameters
+        :return: returns the full NLP service responses, in the order of the texts
+        """
+        return [response for response, _ in self.query_batch_with_status(texts, metadata, application_params)]
 
-            annotation_index = 0
+    def query_batch_with_status(self, texts, metadata=None, application_params=None):
+        """
+        Sends the documents to the NLP service like :meth:`query_batch`, reporting the partial failures
+        :param texts: the texts to be processed
+        :param metadata: metadata fields to be included with the response
+        :param application_params: application parameters
+        :return: the (full NLP service response, whether all the endpoints returned the annotations) pairs,
+                 in the order of the texts
+        """
+        metadata = metadata or {}
+        application_params = application_params or {}
 
-            current_timestamp = datetime.now().strftime("%H:%M:%S")
+        if not self.bulk_url_endpoints or len(self.endpoint_request_mode) > 0:
+            return [self._query(text, metadata, application_params) for text in texts]
 
-            for response in request_responses:
-                if "result" in response.keys():
-                    if type(response["result"]) is not dict:
-                        response["result"] =json.loads(response["result"])
+        try:
+            headers = self.JSON_HEADERS
+            query_body = {
+                "content": [{"text": text, "footer": metadata} for text in texts],
+                "application_params": application_params
+            }
+            query_body = orjson.dumps(query_body)
 
-                    if "medcat_info" in response.keys() and "annotations" in response["result"].keys():
-                        for k in response["result"]["annotations"]["entities"].keys():
-                            response["result"]["annotations"]["entities"][k].update(response["medcat_info"])
-                            response["result"]["annotations"]["entities"][k].update({"timestamp" : response["result"]["timestamp"]})
-                    final_response = response
+            # the responses of all the endpoints, split per document
+            documents_responses = [[] for _ in texts]
+            documents_complete = [True] * len(texts)
 
-                # Entities are present alone only when using GATE-NLP MODE ENDPOINT, they need formatting to match the MedCAT entities structure
-                if self.endpoint_request_mode == 'gate-nlp':
-                    if "entities" in response.keys() and response["entities"] is not None:
-                        tmp_ents = response["entities"]
-                        formatted_result = {}
-                        for entity_type in tmp_ents.keys():
-                            for i in range(len(tmp_ents[entity_type])):
-                                annotation_indices = list(map(int, tmp_ents[entity_type][i]["indices"]))
+            for url, current_request in zip(self.bulk_url_endpoints, self._post_all(self.bulk_url_endpoints, query_body, headers)):
 
-                                tmp_ents[entity_type][i].update({"type" : str(entity_type), "id" : annotation_index, "pipeline_url" : response["pipeline_url"], "timestamp" : current_timestamp,
-                                 "source_value" : response["text"][annotation_indices[0]:annotation_indices[1]]})
+                results = current_request.get("result") if current_request else None
+                if type(results) is not list or len(results) != len(texts):
+                    self.log.warning("bulk request to " + url + " did not return a result for each document")
+                    results = [None] * len(texts)
 
-                                formatted_result[str(annotation_index)] = tmp_ents[entity_type][i]
-                                annotation_index += 1
-                        response["entities"] = formatted_result
+                for i, (document_responses, result) in enumerate(zip(documents_responses, results)):
+                    if result is None:
+                        document_responses.append({})
+                        documents_complete[i] = False
+                        continue
 
-                    for k, v in response.items():
-                        if k in final_response.keys():
-                            if type(v) is dict:
-                                final_response[k].update(v)
-                        elif k != "pipeline_url":
-                            final_response[k] = v
+                    response = {"result": result}
+                    if "medcat_info" in current_request:
+                        response["medcat_info"] = current_request["medcat_info"]
+                    document_responses.append(response)
 
-            return final_response
+            return [(self._merge_responses(document_responses), complete)
+                    for document_responses, complete in zip(documents_responses, documents_complete)]
         except Exception:
-            logging.error(traceback.print_exc())
+            self.log.exception("Exception caught while querying the NLP service")
+            return [(None, False)] * len(texts)
 
 
 ################################
@@ -150,7 +324,7 @@ class BioyodieService(NlpService):
         """
         super().__init__(url_endpoint)
 
-    def query(self, text, metadata={}, application_params={'annotationSets': "Bio:*"}):
+    def query(self, text, metadata=None, application_params=None):
         """
         Sends the document to the NLP service to receive back the annotations
         :param text: the text to be processed
@@ -158,4 +332,6 @@ class BioyodieService(NlpService):
         :param application_params: the NLP application runtime params
         :return: returns the full NLP service response
         """
+        if application_params is None:
+            application_params = {'annotationSets': "Bio:*"}
         return super().query(text, metadata, application_params)
@@ -1,19 +1,49 @@
 #!/usr/bin/python
 
-import json
+import orjson
 import requests
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 def check_url_available(urls, timeout=10):
+    """
+    Checks that all the urls can be connected to, any HTTP response counts as available
+    The urls are checked concurrently with HEAD requests, so that no response body is downloaded
+    """
+    def check(url):
+        logging.info(url)
+        requests.head(url, timeout=timeout)
+
     try:
-        for url in urls:
-            logging.info(url)
-            _ = requests.get(url, timeout=timeout)
+        with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+            list(executor.map(check, urls))
         return True
-    except requests.ConnectionError:
+    except requests.RequestException:
         return False
 
 def remove_duplicate_records(list_of_dicts):
-  list_of_strings = [json.dumps(d, sort_keys=True) for d in list_of_dicts]  
-  list_of_strings = set(list_of_strings)  
-  return [json.loads(s) for s in list_of_strings]
+  """
+  Removes the duplicated records, keeping the first occurrence of each in the original order
+  The records are compared by their canonical serialization, without decoding them back
+  """
+  seen = set()
+  unique_records = []
+  for d in list_of_dicts:
+    key = orjson.dumps(d, option=orjson.OPT_SORT_KEYS, default=str)
+    if key not in seen:
+      seen.add(key)
+      unique_records.append(d)
+  return unique_records
+
+
+def chunked(iterable, size):
+  """
+  Splits the iterable into lists of at most `size` elements, consuming it lazily
+  """
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk